@@ -1 +1,3 @@
-from .main import app, pg
+from .main import app, create_app
+from .connections import get_pg, get_redis
+from .store import get_store
@@ -0,0 +1,149 @@
+import os
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    from .connections import get_redis
+    from .helpers import token_urlsafe
+except SystemError:
+    from connections import get_redis
+    from helpers import token_urlsafe
+
+# seconds we wait for any single call to an external provider
+TIMEOUT = 10
+
+# the circuit opens after FAILURE_THRESHOLD failures within FAILURE_WINDOW
+# seconds and stays open for OPEN_DURATION; after that a single probe call
+# is let through and decides whether it closes again
+FAILURE_THRESHOLD = 5
+FAILURE_WINDOW = 30
+OPEN_DURATION = 30
+
+# calls in flight to the same provider, across all workers
+MAX_CONCURRENT = 8
+
+# a hedged GET fires a second identical request after this many seconds
+HEDGE_DELAY = 1.5
+
+
+class ProviderUnavailable(Exception):
+    pass
+
+
+@contextmanager
+def guard(provider, ignore=()):
+    """
+    Wraps calls to an external provider with a circuit breaker and a
+    concurrency cap, both shared by all workers through redis. Exceptions
+    raised inside the block count as failures, except those in `ignore`.
+    """
+    redis = get_redis()
+    key = "breaker:" + provider
+
+    is_open, tripped = redis.mget(key + ":open", key + ":tripped")
+    if is_open:
+        raise ProviderUnavailable(provider)
+    if tripped and not redis.set(key + ":probe", 1, nx=True, ex=int(TIMEOUT * 2) + 1):
+        # half-open and someone else is already probing
+        raise ProviderUnavailable(provider)
+
+    call = _acquire(redis, key)
+    if not call:
+        if tripped:
+            redis.delete(key + ":probe")
+        raise ProviderUnavailable(provider)
+
+    try:
+        yield
+    except ignore:
+        raise
+    except Exception:
+        _failure(redis, key, probing=bool(tripped))
+        raise
+    else:
+        if tripped:
+            redis.delete(key + ":tripped", key + ":failures")
+    finally:
+        _release(redis, key, call)
+        if tripped:
+            redis.delete(key + ":probe")
+
+
+def _acquire(redis, key):
+    """Takes one of the MAX_CONCURRENT slots, returns its id or None."""
+    # each call is a member scored by its deadline, so the slots of calls
+    # whose worker died without cleaning up free themselves
+    call = token_urlsafe(8)
+    now = time.time()
+    inflight = redis.pipeline()
+    inflight.zremrangebyscore(key + ":inflight", 0, now)
+    inflight.execute_command("ZADD", key + ":inflight", now + TIMEOUT * 3, call)
+    inflight.zcard(key + ":inflight")
+    inflight.expire(key + ":inflight", int(TIMEOUT * 3) + 1)
+    if inflight.execute()[2] > MAX_CONCURRENT:
+        redis.zrem(key + ":inflight", call)
+        return None
+    return call
+
+
+def _release(redis, key, call):
+    redis.zrem(key + ":inflight", call)
+
+
+def _failure(redis, key, probing):
+    pipe = redis.pipeline()
+    pipe.incr(key + ":failures")
+    pipe.expire(key + ":failures", FAILURE_WINDOW)
+    failures = pipe.execute()[0]
+
+    if probing or failures >= FAILURE_THRESHOLD:
+        pipe = redis.pipeline()
+        pipe.set(key + ":open", 1, ex=OPEN_DURATION)
+        pipe.set(key + ":tripped", 1)
+        pipe.execute()
+
+
+_executor = None
+_executor_pid = None
+
+
+def hedged(fn, provider, delay=HEDGE_DELAY):
+    """
+    Calls fn() and, if it hasn't returned after `delay` seconds, calls it
+    once more in parallel, returning whichever succeeds first. Only use it
+    for idempotent requests, inside guard(provider): the second call takes
+    another of the provider's slots, and isn't made when none is free.
+    """
+    global _executor, _executor_pid
+    if _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT * 2)
+        _executor_pid = os.getpid()
+
+    futures = [_executor.submit(fn)]
+    try:
+        return futures[0].result(timeout=delay)
+    except Exception:
+        if not futures[0].done():
+            redis = get_redis()
+            key = "breaker:" + provider
+            call = _acquire(redis, key)
+            if call:
+                futures.append(_executor.submit(fn))
+
+                # guard() gives its slot back as soon as we return, so this
+                # one is held until both requests are really over
+                def release(_):
+                    if all(future.done() for future in futures):
+                        _release(redis, key, call)
+
+                for future in futures:
+                    future.add_done_callback(release)
+
+    error = None
+    for future in as_completed(futures):
+        try:
+            return future.result()
+        except Exception as e:
+            error = e
+    raise error
@@ -0,0 +1,220 @@
+import os
+import time
+import threading
+from collections import namedtuple
+from urllib.parse import urlparse
+
+import click
+from flask.cli import with_appcontext
+
+try:
+    from .connections import get_redis, RETRY_AFTER
+    from .store import get_store
+    from . import snapshot
+    from .snapshot import DATABASE_ERRORS
+except SystemError:
+    from connections import get_redis, RETRY_AFTER
+    from store import get_store
+    import snapshot
+    from snapshot import DATABASE_ERRORS
+
+# registered relying parties are loaded once into memory and matched there,
+# so enforcing their policies doesn't cost a query per login. writes
+# announce themselves on a redis channel and every process drops its copy.
+CHANNEL = "clients:changed"
+MAX_AGE = 300
+
+Client = namedtuple(
+    "Client",
+    ["client_id", "site_name", "redirect_prefixes", "token_lifetime", "providers"],
+)
+
+
+def allows_provider(client, provider):
+    return not client.providers or provider in client.providers
+
+
+_policies = None
+_loaded_at = 0
+_pid = None
+
+
+def find(redirect_uri):
+    """Returns the client whose longest redirect prefix matches, if any."""
+    try:
+        scheme, host, path = _split(redirect_uri)
+    except ValueError:
+        return None
+
+    # the scheme and host must be the same, only the path is a prefix
+    for prefix, client in _load():
+        if (scheme, host) == prefix[:2] and path.startswith(prefix[2]):
+            return client
+    return None
+
+
+def _split(url):
+    u = urlparse(url)
+    return u.scheme.lower(), u.netloc.lower(), u.path
+
+
+def parse_prefix(prefix):
+    """
+    Splits a redirect prefix into (scheme, host, path), raising ValueError
+    unless it has all three and the path ends with a `/`.
+    """
+    u = urlparse(prefix)
+    if (
+        u.scheme not in ("http", "https")
+        or not u.hostname
+        or not u.path.endswith("/")
+        or u.params
+        or u.query
+        or u.fragment
+    ):
+        raise ValueError(
+            "redirect prefix {} must look like https://site.com/path/".format(prefix)
+        )
+    return _split(prefix)
+
+
+def _load():
+    global _policies, _loaded_at
+
+    if _pid != os.getpid():
+        _listen()
+
+    policies = _policies
+    if policies is not None and time.time() - _loaded_at < MAX_AGE:
+        return policies
+
+    loaded_at = time.time()
+    try:
+        rows = get_store().clients()
+    except DATABASE_ERRORS:
+        # keep enforcing the policies we have while postgres is away, or
+        # the ones in the local snapshot if this process has none yet, and
+        # only ask postgres again once it may be back
+        _loaded_at = loaded_at - MAX_AGE + RETRY_AFTER
+        if policies is not None:
+            return policies
+        rows = snapshot.clients()
+        if rows is None:
+            raise
+        loaded_at = _loaded_at
+
+    policies = []
+    for client_id, site_name, prefixes, lifetime, providers in rows:
+        client = Client(
+            client_id,
+            site_name,
+            tuple(prefixes),
+            lifetime,
+            frozenset(providers or ()),
+        )
+        # prefixes saved before they were checked still need an exact host
+        policies.extend((_split(prefix), client) for prefix in prefixes)
+    policies.sort(key=lambda p: len(p[0][2]), reverse=True)
+
+    _policies = policies
+    _loaded_at = loaded_at
+    return policies
+
+
+def invalidate():
+    global _policies
+    _policies = None
+    get_redis().publish(CHANNEL, "1")
+
+
+def _listen():
+    global _pid
+    _pid = os.getpid()
+    threading.Thread(target=_run, name="clients-listener", daemon=True).start()
+
+
+def _run():
+    global _policies
+    while True:
+        try:
+            pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(CHANNEL)
+            for message in pubsub.listen():
+                if message["type"] == "message":
+                    _policies = None
+        except Exception:
+            # we'll still reload after MAX_AGE while redis is away
+            _policies = None
+            time.sleep(5)
+
+
+def save(
+    client_id, redirect_prefixes, site_name=None, token_lifetime=None, providers=None
+):
+    for prefix in redirect_prefixes:
+        parse_prefix(prefix)
+
+    get_store().save_client(
+        client_id, redirect_prefixes, site_name, token_lifetime, providers
+    )
+    invalidate()
+
+
+def delete(client_id):
+    deleted = get_store().delete_client(client_id)
+    invalidate()
+    return deleted
+
+
+@click.group("clients")
+def clients_command():
+    """Manages registered relying parties."""
+
+
+@clients_command.command("add")
+@click.argument("client_id")
+@click.option(
+    "--redirect",
+    "redirect_prefixes",
+    multiple=True,
+    required=True,
+    help="allowed redirect_uri prefix, including the path (e.g. https://site.com/)",
+)
+@click.option("--site-name", help="name shown on /login-screen")
+@click.option("--token-lifetime", type=int, help="seconds until tokens expire")
+@click.option("--provider", "providers", multiple=True, help="allowed provider")
+@with_appcontext
+def add_command(client_id, redirect_prefixes, site_name, token_lifetime, providers):
+    """Registers or updates a client."""
+    try:
+        save(client_id, redirect_prefixes, site_name, token_lifetime, providers)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo("saved {}".format(client_id))
+
+
+@clients_command.command("remove")
+@click.argument("client_id")
+@with_appcontext
+def remove_command(client_id):
+    """Removes a client."""
+    if not delete(client_id):
+        raise click.ClickException("no client {}".format(client_id))
+    click.echo("removed {}".format(client_id))
+
+
+@clients_command.command("list")
+@with_appcontext
+def list_command():
+    """Lists registered clients."""
+    clients = set(client for _, client in _load())
+    for client in sorted(clients):
+        click.echo(
+            "{}\t{}\t{}\t{}\t{}".format(
+                client.client_id,
+                client.site_name or "-",
+                ",".join(client.redirect_prefixes),
+                client.token_lifetime or "-",
+                ",".join(sorted(client.providers)) or "*",
+            )
+        )
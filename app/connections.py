@@ -0,0 +1,89 @@
+import os
+import time
+from urllib import parse
+
+import psycopg2
+from redis import StrictRedis
+
+# connections are created lazily, once per process. when a process forks
+# (e.g. gunicorn workers with --preload) the child notices the pid change
+# and opens its own connections instead of sharing the parent's sockets.
+_config = {}
+
+# seconds to wait for postgres to accept a connection, so an unreachable
+# host fails fast (and we fall back) instead of hanging the request
+CONNECT_TIMEOUT = 3
+
+# after a failed connection we don't try again for this many seconds, so
+# during an outage requests fall back at once instead of each waiting for
+# CONNECT_TIMEOUT
+RETRY_AFTER = 5
+
+_pg = None
+_pg_down_until = 0
+_redis = None
+_pid = None
+_inherited = []
+
+
+def init_app(app):
+    _config["DATABASE_URL"] = app.config["DATABASE_URL"]
+    _config["REDIS_URL"] = app.config["REDIS_URL"]
+
+
+def get_pg():
+    global _pg, _pg_down_until
+    _check_pid()
+    if _pg is None or _pg.closed:
+        if time.time() < _pg_down_until:
+            raise psycopg2.OperationalError("postgres was unreachable moments ago")
+        try:
+            _pg = psycopg2.connect(
+                _config["DATABASE_URL"], connect_timeout=CONNECT_TIMEOUT
+            )
+        except psycopg2.OperationalError:
+            _pg_down_until = time.time() + RETRY_AFTER
+            raise
+    return _pg
+
+
+def get_redis():
+    global _redis
+    _check_pid()
+    if _redis is None:
+        r = parse.urlparse(_config["REDIS_URL"])
+        _redis = StrictRedis(host=r.hostname, port=r.port, password=r.password)
+    return _redis
+
+
+def reset():
+    """Forgets the connections inherited from a parent process."""
+    global _pg, _redis, _pid
+
+    if _pg is not None and not _pg.closed:
+        # the socket is shared with the parent, so point our copy of the
+        # descriptor to /dev/null first: closing it here must not end the
+        # parent's session
+        devnull = os.open(os.devnull, os.O_RDWR)
+        os.dup2(devnull, _pg.fileno())
+        os.close(devnull)
+        _pg.close()
+
+    # redis clients shutdown() their sockets when disconnected, which would
+    # also end the parent's connection, so the inherited one is kept
+    # referenced (and never collected) for as long as this process lives;
+    # there's at most one per fork.
+    if _redis is not None:
+        _inherited.append(_redis)
+
+    _pg = None
+    _redis = None
+    _pid = os.getpid()
+
+
+def _check_pid():
+    global _pid
+    if _pid is None:
+        _pid = os.getpid()
+    elif _pid != os.getpid():
+        reset()
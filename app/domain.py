@@ -1,16 +1,16 @@
 from urllib import parse
 
 import requests
-from flask import redirect, url_for, request, g
+from flask import current_app, redirect, url_for, request, g
 
 try:
-    from .main import app
+    from .breaker import guard, TIMEOUT
 except SystemError:
-    from main import app
+    from breaker import guard, TIMEOUT
 
 
 def redir():
-    return app.config["SERVICE_URL"] + url_for(".callback", provider="domain")
+    return current_app.config["SERVICE_URL"] + url_for(".callback", provider="domain")
 
 
 def handle():
@@ -20,7 +20,7 @@ def handle():
         + parse.urlencode(
             {
                 "me": domain,
-                "client_id": app.config["SERVICE_URL"],
+                "client_id": current_app.config["SERVICE_URL"],
                 "redirect_uri": redir(),
             }
         )
@@ -29,15 +29,19 @@ def handle():
 
 def callback():
     code = request.args["code"]
-    r = requests.post(
-        "https://indieauth.com/auth",
-        data={
-            "code": code,
-            "redirect_uri": redir(),
-            "client_id": app.config["SERVICE_URL"],
-        },
-        headers={"Accept": "application/json"},
-    )
+    with guard("domain"):
+        r = requests.post(
+            "https://indieauth.com/auth",
+            data={
+                "code": code,
+                "redirect_uri": redir(),
+                "client_id": current_app.config["SERVICE_URL"],
+            },
+            headers={"Accept": "application/json"},
+            timeout=TIMEOUT,
+        )
+        if r.status_code >= 500:
+            raise Exception(r.text)
     if not r.ok:
         raise Exception(r.text)
 
@@ -1,65 +1,67 @@
-import random
-
 from portier.client import get_verified_email
-from flask import session, request, url_for, g
+from flask import current_app, request, url_for, g, render_template
 
 try:
-    from .main import app
+    from .helpers import token_urlsafe
+    from .connections import get_redis
+    from .breaker import guard
 except SystemError:
-    from main import app
+    from helpers import token_urlsafe
+    from connections import get_redis
+    from breaker import guard
 
 PORTIER_BROKER = "https://broker.portier.io"
 
 
 def handle():
     email = g.account
-    nonce = "{}".format(random.random())
-    redirect = app.config["SERVICE_URL"] + url_for(".callback", provider="email")
+    nonce = token_urlsafe(24)
+    redirect = current_app.config["SERVICE_URL"] + url_for(
+        ".callback", provider="email"
+    )
 
     cache = Cache()
     cache.set("portier:nonce:%s" % nonce, redirect, 0)
 
-    return """
-<form id="form" action="{portier}/auth" method="post" style="display:none;">
-  <input name="login_hint" value="{email}">
-  <input name="scope" value="openid email">
-  <input name="response_type" value="id_token">
-  <input name="response_mode" value="form_post">
-  <input name="redirect_uri" value="{redirect}">
-  <input name="client_id" value="{url}">
-  <input name="nonce" value="{nonce}">
-</form>
-<script>document.getElementById('form').submit()</script>
-    """.format(
+    return render_template(
+        "portier-form.html",
         portier=PORTIER_BROKER,
         email=email,
         redirect=redirect,
-        url=app.config["SERVICE_URL"],
+        url=current_app.config["SERVICE_URL"],
         nonce=nonce,
     )
 
 
 def callback():
-    try:
+    # invalid tokens are raised as RuntimeError, those aren't the broker's fault
+    with guard("email", ignore=(RuntimeError,)):
         email, _ = get_verified_email(
             broker_url=PORTIER_BROKER,
             token=request.form["id_token"],
-            audience=app.config["SERVICE_URL"],
+            audience=current_app.config["SERVICE_URL"],
             issuer=PORTIER_BROKER,
             cache=Cache(),
         )
-    except RuntimeError as exc:
-        raise exc
 
     return email
 
 
 class Cache(object):
+    # shared by all nodes, portier stores the login nonces here (and deletes
+    # them once used) along with the broker's keys
+    ttl = 600
+
     def get(self, key):
-        return session.get("pc:" + key)
+        value = get_redis().get("pc:" + key)
+        return value.decode("utf-8") if value is not None else None
 
     def set(self, key, value, timeout):
-        session["pc:" + key] = value
+        get_redis().set("pc:" + key, value, ex=int(timeout) or self.ttl)
 
     def delete(self, key):
-        session.pop("pc:" + key)
+        pipe = get_redis().pipeline()
+        pipe.get("pc:" + key)
+        pipe.delete("pc:" + key)
+        value, _ = pipe.execute()
+        return value.decode("utf-8") if value is not None else None
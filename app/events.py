@@ -0,0 +1,358 @@
+import os
+import glob
+import json
+import time
+import atexit
+import socket
+import logging
+import datetime
+import threading
+from collections import deque
+
+import click
+from flask.cli import with_appcontext
+from psycopg2.extras import execute_values
+
+try:
+    from .connections import get_pg, get_redis
+except SystemError:
+    from connections import get_pg, get_redis
+
+# events emitted during requests are kept in a bounded in-process buffer and
+# published to a redis stream in batches by a background thread, so the
+# request only pays for a deque append.
+STREAM = "accountd:events"
+STREAM_MAXLEN = 1000000
+GROUP = "accountd:events:pg"
+BUFFER_SIZE = 10000
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 0.5
+
+# on exit the buffer gets a few more tries and is then written to a file in
+# SPILL_DIR, for any process that is still running to publish later
+EXIT_RETRIES = 3
+REPLAY_INTERVAL = 30
+DROPPED = "accountd:events:dropped"
+
+# entries delivered to a consumer that hasn't acknowledged them for this
+# long (in ms) are taken over by another one, as it has probably died
+CLAIM_IDLE = 60000
+
+logger = logging.getLogger(__name__)
+_config = {}
+
+_buffer = deque()
+_wakeup = threading.Event()
+_flush_lock = threading.Lock()
+_thread = None
+_pid = None
+
+# how many events were discarded because the buffer was full, and how many
+# of those still have to be added to the DROPPED counter in redis
+dropped = 0
+_unreported = 0
+
+
+def init_app(app):
+    _config["SPILL_DIR"] = app.config["EVENTS_SPILL_DIR"]
+
+
+def stats():
+    """
+    Counts for this process. Drops from all processes are added up in redis,
+    under DROPPED, as they're flushed.
+    """
+    return {"buffered": len(_buffer), "dropped": dropped}
+
+
+def emit(kind, **fields):
+    global dropped, _unreported
+
+    if _pid != os.getpid():
+        _start()
+
+    if len(_buffer) >= BUFFER_SIZE:
+        dropped += 1
+        _unreported += 1
+        if dropped % 1000 == 1:
+            logger.warning("event buffer is full, %d events dropped so far", dropped)
+        return
+
+    fields["kind"] = kind
+    fields["ts"] = time.time()
+    _buffer.append(fields)
+
+    if len(_buffer) >= BATCH_SIZE:
+        _wakeup.set()
+
+
+def flush():
+    """Publishes everything in the buffer to the stream."""
+    global _unreported
+
+    with _flush_lock:
+        while _buffer:
+            batch = []
+            while _buffer and len(batch) < BATCH_SIZE:
+                batch.append(_buffer.popleft())
+
+            try:
+                _publish(batch)
+            except Exception:
+                # put them back, we'll try again later
+                _buffer.extendleft(reversed(batch))
+                raise
+
+        if _unreported:
+            unreported = _unreported
+            get_redis().incrby(DROPPED, unreported)
+            _unreported -= unreported
+
+
+def _publish(batch):
+    pipe = get_redis().pipeline(transaction=False)
+    for event in batch:
+        pipe.execute_command(
+            "XADD",
+            STREAM,
+            "MAXLEN",
+            "~",
+            STREAM_MAXLEN,
+            "*",
+            "event",
+            json.dumps(event),
+        )
+    pipe.execute()
+
+
+def flush_on_exit():
+    """
+    Like flush(), but never raises: if redis can't be reached the buffer is
+    written to SPILL_DIR instead.
+    """
+    if _pid != os.getpid() or not (_buffer or _unreported):
+        return
+
+    for attempt in range(EXIT_RETRIES):
+        try:
+            flush()
+            return
+        except Exception:
+            time.sleep(FLUSH_INTERVAL * (attempt + 1))
+
+    with _flush_lock:
+        if not _buffer:
+            return
+        path = os.path.join(
+            _config["SPILL_DIR"], "events-{}-{}.jsonl".format(os.getpid(), time.time())
+        )
+        try:
+            with open(path + ".tmp", "w") as f:
+                for event in _buffer:
+                    f.write(json.dumps(event) + "\n")
+            os.rename(path + ".tmp", path)
+        except Exception:
+            logger.exception("couldn't save %d events to %s", len(_buffer), path)
+            return
+        logger.warning(
+            "redis is unreachable, saved %d events to %s", len(_buffer), path
+        )
+        _buffer.clear()
+
+
+def replay():
+    """Publishes the events other processes saved on their way out."""
+    for path in glob.glob(os.path.join(_config["SPILL_DIR"], "events-*.jsonl")):
+        # renaming it first makes sure only one process takes each file
+        claimed = "{}.{}".format(path, os.getpid())
+        try:
+            os.rename(path, claimed)
+        except OSError:
+            continue
+
+        try:
+            with open(claimed) as f:
+                spilled = [json.loads(line) for line in f if line.strip()]
+            for i in range(0, len(spilled), BATCH_SIZE):
+                _publish(spilled[i : i + BATCH_SIZE])
+        except Exception:
+            # try again later; a batch published just before this failed
+            # will be published twice
+            os.rename(claimed, path)
+            raise
+        os.remove(claimed)
+
+
+def _start():
+    global _thread, _pid
+
+    # a forked worker doesn't inherit the parent's thread, only its buffer
+    _pid = os.getpid()
+    _buffer.clear()
+    _thread = threading.Thread(target=_run, name="events-flusher", daemon=True)
+    _thread.start()
+
+
+def _run():
+    replayed_at = 0
+    while True:
+        _wakeup.wait(FLUSH_INTERVAL)
+        _wakeup.clear()
+        try:
+            flush()
+            if time.time() - replayed_at > REPLAY_INTERVAL:
+                replay()
+                replayed_at = time.time()
+        except Exception:
+            time.sleep(FLUSH_INTERVAL)
+
+
+atexit.register(flush_on_exit)
+
+
+@click.command("consume-events")
+@click.option(
+    "--consumer",
+    envvar="EVENTS_CONSUMER",
+    default=socket.gethostname,
+    help="a name that stays the same when this consumer restarts",
+)
+@click.option("--batch", default=BATCH_SIZE)
+@with_appcontext
+def consume_command(consumer, batch):
+    """Copies events from the redis stream into postgres."""
+    consume(consumer, batch)
+
+
+def consume(consumer, batch=BATCH_SIZE, block=5000, once=False):
+    redis = get_redis()
+    try:
+        redis.execute_command("XGROUP", "CREATE", STREAM, GROUP, "0", "MKSTREAM")
+    except Exception as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+    # start with events that were delivered to us, or to a consumer that is
+    # gone, but never acknowledged (e.g. it crashed while inserting them)
+    claim_abandoned(consumer)
+    last_id = "0"
+    while True:
+        reply = redis.execute_command(
+            "XREADGROUP",
+            "GROUP",
+            GROUP,
+            consumer,
+            "COUNT",
+            batch,
+            "BLOCK",
+            block,
+            "STREAMS",
+            STREAM,
+            last_id,
+        )
+        entries = reply[0][1] if reply else []
+
+        if entries:
+            ids = store_events(entries)
+            redis.execute_command("XACK", STREAM, GROUP, *ids)
+        elif last_id == "0":
+            # no more pending events, now wait for new ones
+            last_id = ">"
+        elif claim_abandoned(consumer):
+            last_id = "0"
+        elif once:
+            return
+
+
+def claim_abandoned(consumer, count=BATCH_SIZE):
+    """
+    Moves entries other consumers have left unacknowledged for CLAIM_IDLE
+    to `consumer`'s pending list. Returns how many.
+    """
+    redis = get_redis()
+    pending = redis.execute_command(
+        "XPENDING", STREAM, GROUP, "-", "+", count, parse_detail=True
+    )
+
+    ids = []
+    for entry in pending:
+        if isinstance(entry, dict):
+            # newer redis clients parse the reply
+            entry = (
+                entry["message_id"],
+                entry["consumer"],
+                entry["time_since_delivered"],
+            )
+        entry_id, owner, idle = entry[:3]
+        if isinstance(owner, bytes):
+            owner = owner.decode("utf-8")
+        if owner != consumer and idle >= CLAIM_IDLE:
+            ids.append(entry_id)
+    if not ids:
+        return 0
+
+    claimed = redis.execute_command(
+        "XCLAIM", STREAM, GROUP, consumer, CLAIM_IDLE, *ids, "JUSTID", parse_justid=True
+    )
+    return len(claimed)
+
+
+def store_events(entries):
+    rows = []
+    ids = []
+    for entry_id, fields in entries:
+        if isinstance(entry_id, bytes):
+            entry_id = entry_id.decode("ascii")
+        ids.append(entry_id)
+        if not fields:
+            # trimmed from the stream before we could read it
+            continue
+
+        if not isinstance(fields, dict):
+            fields = dict(zip(fields[::2], fields[1::2]))
+        event = fields.get(b"event", fields.get("event"))
+        if isinstance(event, bytes):
+            # json.loads only takes str before python 3.6
+            event = event.decode("utf-8")
+        event = json.loads(event)
+        created_at = datetime.datetime.fromtimestamp(
+            event.pop("ts"), datetime.timezone.utc
+        )
+        rows.append(
+            (
+                entry_id,
+                event.pop("kind"),
+                event.pop("user", None),
+                event.pop("account", None),
+                event.pop("provider", None),
+                created_at,
+                json.dumps(event),
+            )
+        )
+
+    pg = get_pg()
+    with pg:
+        with pg.cursor() as c:
+            for month in set((r[5].year, r[5].month) for r in rows):
+                ensure_partition(c, *month)
+
+            execute_values(
+                c,
+                "INSERT INTO events "
+                "(id, kind, user_id, account, provider, created_at, data) "
+                "VALUES %s ON CONFLICT DO NOTHING",
+                rows,
+            )
+
+    return ids
+
+
+def ensure_partition(c, year, month):
+    name = "events_{}_{:02d}".format(year, month)
+    start = datetime.date(year, month, 1)
+    end = datetime.date(year + month // 12, month % 12 + 1, 1)
+    c.execute(
+        "CREATE TABLE IF NOT EXISTS {} PARTITION OF events "
+        "FOR VALUES FROM (%s) TO (%s)".format(name),
+        (start, end),
+    )
@@ -1,27 +1,27 @@
 import os
 import json
-import random
 from urllib.parse import urlencode
 
-from flask import redirect, url_for, request, session
+from flask import current_app, redirect, url_for, request
 import requests
 
 try:
-    from .main import app
+    from . import nonces
+    from .breaker import guard, hedged, TIMEOUT
 except SystemError:
-    from . import app
+    import nonces
+    from breaker import guard, hedged, TIMEOUT
 
 consumer_key = os.getenv("GITHUB_KEY")
 consumer_secret = os.getenv("GITHUB_SECRET")
 
 
 def redir():
-    return app.config["SERVICE_URL"] + url_for(".callback", provider="github")
+    return current_app.config["SERVICE_URL"] + url_for(".callback", provider="github")
 
 
 def handle():
-    nonce = random.random()
-    session["gh:nonce"] = nonce
+    nonce = nonces.issue("github")
 
     return redirect(
         "https://github.com/login/oauth/authorize?"
@@ -32,21 +32,27 @@ def handle():
 
 
 def callback():
-    r = requests.post(
-        "https://github.com/login/oauth/access_token",
-        data=json.dumps(
-            {
-                "code": request.args["code"],
-                "client_id": consumer_key,
-                "client_secret": consumer_secret,
-                "redirect_uri": redir(),
-                "nonce": session["gh:nonce"],
-            }
-        ),
-        headers={"Content-Type": "application/json", "Accept": "application/json"},
-    )
-
-    del session["gh:nonce"]
+    state = request.args.get("state")
+    if not nonces.consume("github", state):
+        raise Exception("invalid or expired state.")
+
+    with guard("github"):
+        r = requests.post(
+            "https://github.com/login/oauth/access_token",
+            data=json.dumps(
+                {
+                    "code": request.args["code"],
+                    "client_id": consumer_key,
+                    "client_secret": consumer_secret,
+                    "redirect_uri": redir(),
+                    "state": state,
+                }
+            ),
+            headers={"Content-Type": "application/json", "Accept": "application/json"},
+            timeout=TIMEOUT,
+        )
+        if r.status_code >= 500:
+            raise Exception("github is failing: " + r.text)
 
     if not r.ok:
         raise Exception("failed to fetch access token from github.")
@@ -55,15 +61,22 @@ def callback():
     if not token:
         raise Exception("github hasn't issued a token to us for some reason: " + r.text)
 
-    r = requests.get(
-        "https://api.github.com/user",
-        headers={
-            "User-Agent": "accountd.xyz",
-            "Authorization": "token " + token,
-            "Content-Type": "application/json",
-            "Accept": "application/vnd.github.v3+json",
-        },
-    )
+    with guard("github"):
+        r = hedged(
+            lambda: requests.get(
+                "https://api.github.com/user",
+                headers={
+                    "User-Agent": "accountd.xyz",
+                    "Authorization": "token " + token,
+                    "Content-Type": "application/json",
+                    "Accept": "application/vnd.github.v3+json",
+                },
+                timeout=TIMEOUT,
+            ),
+            "github",
+        )
+        if r.status_code >= 500:
+            raise Exception("github is failing: " + r.text)
 
     if not r.ok:
         raise Exception("failed to fetch user login from github after oauth.", r.text)
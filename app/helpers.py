@@ -1,5 +1,15 @@
 import re
 
+try:
+    from secrets import token_urlsafe
+except ImportError:
+    # python < 3.6
+    import os
+    import base64
+
+    def token_urlsafe(nbytes):
+        return base64.urlsafe_b64encode(os.urandom(nbytes)).rstrip(b"=").decode("ascii")
+
 
 def account_type(account):
     if len(account.split("@")) == 1:
@@ -24,3 +34,19 @@ def account_type(account):
 
 def username_valid(user):
     return re.match("^[a-z0-9_]+$", user)
+
+
+def normalize_account(account):
+    # accounts are case-insensitive identifiers, so we store and query
+    # them in a single canonical form
+    if account is None:
+        return None
+
+    # stripping the dots can uncover more whitespace (e.g. "a.com ."), so
+    # this goes on until it's stable, which is what the CHECK on
+    # accounts.account expects
+    while True:
+        normalized = account.strip().rstrip(".").lower()
+        if normalized == account:
+            return normalized
+        account = normalized
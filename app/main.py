@@ -1,13 +1,20 @@
 import os
+import json
+import time
 import random
+import hashlib
+import functools
+import tempfile
+import threading
+import importlib
+from collections import OrderedDict
 from urllib import parse
 
 import jwt
-import psycopg2
-from jwcrypto import jwk as jwcrypto_jwk
-from redis import StrictRedis
 from flask import (
     Flask,
+    Blueprint,
+    current_app,
     session,
     request,
     redirect,
@@ -15,53 +22,166 @@ from flask import (
     jsonify,
     url_for,
     make_response,
+    Response,
     g,
     abort,
 )
 
-app = Flask(__name__)
-app.secret_key = os.getenv("SECRET_KEY")
-app.config["SERVICE_URL"] = os.getenv("SERVICE_URL")
-app.config["PRIVATE_KEY"] = (
-    os.getenv("PRIVATE_KEY").replace("\\n", "\n").encode("ascii")
-)
-app.config["PUBLIC_KEY"] = os.getenv("PUBLIC_KEY").replace("\\n", "\n").encode("ascii")
-app.config["DEBUG"] = os.getenv("DEBUG") == 1
+try:
+    from .helpers import account_type, username_valid, normalize_account
+    from . import connections
+    from . import events
+    from . import clients
+    from . import store
+    from . import snapshot
+    from .sessions import RedisSessionInterface
+    from .breaker import ProviderUnavailable
+    from .connections import get_redis
+    from .store import get_store
+    from .snapshot import DATABASE_ERRORS
+except SystemError:
+    from helpers import account_type, username_valid, normalize_account
+    import connections
+    import events
+    import clients
+    import store
+    import snapshot
+    from sessions import RedisSessionInterface
+    from breaker import ProviderUnavailable
+    from connections import get_redis
+    from store import get_store
+    from snapshot import DATABASE_ERRORS
+
+SEARCH_LIMIT = 20
+SEARCH_CACHE_TTL = 10
+PAGE_CACHE_SIZE = 512
+CHANGES_LIMIT = 1000
+CHANGES_CHANNEL = "accounts:changes"
+CHANGES_POLL_INTERVAL = 15
+CHANGES_STREAM_DURATION = 300
+REMEMBER_FRESH_FOR = 60
+TOKEN_CACHE_SIZE = 4096
+PROVIDERS = ["email", "twitter", "github", "trello", "domain"]
+SCREEN_PROVIDERS = ["twitter", "github", "trello"]
+
+# providers are only imported when first used, as some of them pull in
+# heavy libraries
+PROVIDER_MODULES = {
+    "email": "email_portier",
+    "domain": "domain",
+    "trello": "trello",
+    "twitter": "twitter",
+    "github": "github",
+    "test": "test",
+}
+
+bp = Blueprint("accountd", __name__)
+
+
+def create_app():
+    app = Flask(__name__)
+    app.secret_key = os.getenv("SECRET_KEY")
+    app.config["OLD_SECRET_KEYS"] = [
+        key for key in os.getenv("OLD_SECRET_KEYS", "").split(",") if key
+    ]
+    app.session_interface = RedisSessionInterface()
+    app.config["SERVICE_URL"] = os.getenv("SERVICE_URL")
+    app.config["PRIVATE_KEY"] = (
+        os.getenv("PRIVATE_KEY").replace("\\n", "\n").encode("ascii")
+    )
+    app.config["PUBLIC_KEY"] = (
+        os.getenv("PUBLIC_KEY").replace("\\n", "\n").encode("ascii")
+    )
+    app.config["DEBUG"] = os.getenv("DEBUG") == 1
+    app.config["DATABASE_URL"] = os.getenv("DATABASE_URL")
+    app.config["REDIS_URL"] = os.getenv("REDIS_URL")
+    app.config["REQUIRE_REGISTERED_CLIENTS"] = bool(
+        os.getenv("REQUIRE_REGISTERED_CLIENTS")
+    )
+    app.config["STORE"] = os.getenv("STORE", "postgres")
+    # each event stream holds a worker for up to CHANGES_STREAM_DURATION,
+    # so /changes only streams to this many clients per process, and by
+    # default to none: with gunicorn's sync workers clients poll instead
+    app.config["CHANGES_MAX_STREAMS"] = int(os.getenv("CHANGES_MAX_STREAMS", 0))
+    app.config["SNAPSHOT_PATH"] = os.getenv(
+        "SNAPSHOT_PATH", os.path.join(tempfile.gettempdir(), "accountd.sqlite3")
+    )
+    app.config["EVENTS_SPILL_DIR"] = os.getenv(
+        "EVENTS_SPILL_DIR", tempfile.gettempdir()
+    )
+    app.config["SNAPSHOT_INTERVAL"] = float(
+        os.getenv("SNAPSHOT_INTERVAL", snapshot.REFRESH_INTERVAL)
+    )
 
-r = parse.urlparse(os.getenv("REDIS_URL"))
-redis = StrictRedis(host=r.hostname, port=r.port, password=r.password)
+    connections.init_app(app)
+    store.init_app(app)
+    snapshot.init_app(app)
+    events.init_app(app)
+    app.register_blueprint(bp)
+    app.cli.add_command(events.consume_command)
+    app.cli.add_command(clients.clients_command)
 
-pg = psycopg2.connect(os.getenv("DATABASE_URL"))
+    # compile all templates upfront so the first requests don't have to
+    for template in app.jinja_env.list_templates():
+        app.jinja_env.get_template(template)
 
-try:
-    from .helpers import account_type, username_valid
-    from . import email_portier as email
-    from . import domain
-    from . import trello
-    from . import twitter
-    from . import github
-    from . import test
-except SystemError:
-    from helpers import account_type, username_valid
-    import email_portier as email
-    import domain
-    import trello
-    import twitter
-    import github
-    import test
+    return app
+
+
+def provider_module(provider):
+    try:
+        name = PROVIDER_MODULES[provider]
+    except KeyError:
+        return None
+    if not __package__:
+        # running as a script, the providers are top-level modules too
+        return importlib.import_module(name)
+    return importlib.import_module("." + name, __package__)
+
+
+_page_cache = OrderedDict()
 
 
-@app.route("/")
+@bp.before_request
+def start_snapshot():
+    snapshot.start()
+
+
+def cached_page(key, render):
+    # pages that are the same for every anonymous visitor are rendered once
+    # and then served from memory, with an etag so browsers can revalidate
+    if session.get("authorized_accounts") or session.get("authorized_users"):
+        return render()
+
+    try:
+        body, etag = _page_cache[key]
+        _page_cache.move_to_end(key)
+    except KeyError:
+        body = render()
+        etag = hashlib.sha1(body.encode("utf-8")).hexdigest()
+        _page_cache[key] = (body, etag)
+        if len(_page_cache) > PAGE_CACHE_SIZE:
+            _page_cache.popitem(last=False)
+
+    resp = make_response(body)
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp.make_conditional(request)
+
+
+@bp.route("/")
 def index():
-    return render_template(
-        "landing.html", providers=["email", "twitter", "github", "trello", "domain"]
+    return cached_page(
+        ("landing",), lambda: render_template("landing.html", providers=PROVIDERS)
     )
 
 
-@app.route("/public-key")
+@bp.route("/public-key")
 def public_key():
-    pem = app.config["PUBLIC_KEY"]
+    pem = current_app.config["PUBLIC_KEY"]
     if request.headers.get("Accept") == "application/json":
+        from jwcrypto import jwk as jwcrypto_jwk
+
         jwk = jwcrypto_jwk.JWK.from_pem(pem)
         resp = make_response(jwk.export())
         resp.headers["Content-Type"] = "application/json"
@@ -71,33 +191,62 @@ def public_key():
     return resp
 
 
-@app.route("/login-screen")
+@bp.route("/login-screen")
 def login_screen():
-    return render_template(
-        "login-screen.html",
-        destination=request.args.get("site_name")
-        or request.args.get("redirect_uri")
-        or "a website",
+    site_name = request.args.get("site_name")
+    redirect_uri = request.args.get("redirect_uri")
+
+    client = None
+    if redirect_uri:
+        client = client_for(redirect_uri)
+        if client and client.site_name:
+            site_name = client.site_name
+
+    return cached_page(
+        ("login-screen", site_name, redirect_uri, client),
+        lambda: render_template(
+            "login-screen.html",
+            destination=site_name or redirect_uri or "a website",
+            redirect_uri=redirect_uri or "",
+            providers=[
+                p
+                for p in SCREEN_PROVIDERS
+                if not client or clients.allows_provider(client, p)
+            ],
+            email=not client or clients.allows_provider(client, "email"),
+        ),
     )
 
 
-@app.route("/login/using/<provider>", defaults={"user": None, "account": None})
-@app.route("/login/as/<user>/using/<provider>", defaults={"account": None})
-@app.route("/login/with/<account>", defaults={"user": None, "provider": None})
-@app.route(
+def client_for(redirect_uri):
+    client = clients.find(redirect_uri)
+    if not client and current_app.config["REQUIRE_REGISTERED_CLIENTS"]:
+        abort(
+            make_response(("{} is not a registered client.".format(redirect_uri), 400))
+        )
+    return client
+
+
+@bp.route("/login/using/<provider>", defaults={"user": None, "account": None})
+@bp.route("/login/as/<user>/using/<provider>", defaults={"account": None})
+@bp.route("/login/with/<account>", defaults={"user": None, "provider": None})
+@bp.route(
     "/login/as/<user>/with/<account>",
     endpoint="login_specific",
     defaults={"provider": None},
 )
-@app.route("/login", defaults={"provider": None, "user": None, "account": None})
+@bp.route("/login", defaults={"provider": None, "user": None, "account": None})
 def login(provider, user, account):
     user = user or request.args.get("user")
-    account = account or request.args.get("account")
+    account = normalize_account(account or request.args.get("account"))
     provider = provider or request.args.get("provider")
-    initial_account = request.args.get("initial_account")
+    initial_account = normalize_account(request.args.get("initial_account"))
 
     if "redirect_uri" in request.args:
-        session["redirect_uri"] = request.args["redirect_uri"]
+        redirect_uri = request.args["redirect_uri"]
+        client_for(redirect_uri)
+    else:
+        redirect_uri = session.get("redirect_uri", "")
 
     if user:
         if not username_valid(user):
@@ -115,26 +264,58 @@ def login(provider, user, account):
         provider = account_type(account)
         g.account = account
 
-    try:
-        handle = globals()[provider].handle
-    except KeyError:
+    client = clients.find(redirect_uri)
+    if client and not clients.allows_provider(client, provider):
+        return (
+            "{} doesn't accept logins with {}.".format(client.client_id, provider),
+            403,
+        )
+    # only kept once the client accepts this provider, or a login started
+    # before with another one could still end up there
+    if redirect_uri:
+        session["redirect_uri"] = redirect_uri
+
+    module = provider_module(provider)
+    if not module:
         return "unsupported provider {}".format(provider), 404
 
-    return handle()
+    try:
+        return module.handle()
+    except ProviderUnavailable:
+        return unavailable(provider)
+
+
+def unavailable(provider):
+    return "{} is not responding right now, try again later.".format(provider), 503
+
 
+def database_unavailable(e):
+    # whatever couldn't fall back to the snapshot
+    return unavailable("the database")
 
-@app.route(
+
+for error in DATABASE_ERRORS:
+    bp.register_error_handler(error, database_unavailable)
+
+
+@bp.route(
     "/callback/from/<provider>",
     endpoint="callback",
     defaults={"account": None},
     methods=["GET", "POST"],
 )
-@app.route("/callback", defaults={"provider": None, "account": None})
-@app.route("/authorized/<account>", endpoint="authorized", defaults={"provider": None})
+@bp.route("/callback", defaults={"provider": None, "account": None})
+@bp.route("/authorized/<account>", endpoint="authorized", defaults={"provider": None})
 def callback(provider, account):
     if provider:
+        module = provider_module(provider)
+        if not module:
+            return "unsupported provider {}".format(provider), 404
+
         try:
-            account = globals()[provider].callback()
+            account = module.callback()
+        except ProviderUnavailable:
+            return unavailable(provider)
         except:
             return abort(500)
     elif not account:
@@ -143,6 +324,17 @@ def callback(provider, account):
     if not account:
         return "could not authenticate with {}".format(provider), 403
 
+    account = normalize_account(account)
+
+    # the client may have been chosen after this login was started
+    used = provider or account_type(account)
+    client = clients.find(session.get("redirect_uri", ""))
+    if client and not clients.allows_provider(client, used):
+        return (
+            "{} doesn't accept logins with {}.".format(client.client_id, used),
+            403,
+        )
+
     if session.get("desired_account", account) != account:
         return (
             "you wanted to login as {}, but logged as {}".format(
@@ -158,7 +350,7 @@ def callback(provider, account):
 
     session["authorized_accounts"] = session.get("authorized_accounts", {})
     session["authorized_accounts"][account] = True
-    session.modified = True
+    session.regenerate()
 
     # now we need a username
     # let's see if one was supplied by the visitor
@@ -169,17 +361,24 @@ def callback(provider, account):
     except:
         pass
 
+    # visitors who logged in with this account before carry its binding to
+    # a user in their session, so a returning user can skip the lookups
+    if "initial_account" not in session:
+        remembered = remembered_user(account)
+        if remembered and (not user or user == remembered):
+            events.emit("login", user=remembered, account=account, provider=provider)
+            return return_user_token(remembered)
+
     # if not, we'll check in the database for a previous user that has
     # used this same account (common)
     if not user:
-        with pg:
-            with pg.cursor() as c:
-                c.execute(
-                    "SELECT user_id FROM accounts " "WHERE account = %s", (account,)
-                )
-                if c.rowcount == 0:
-                    return render_template("choose-username.html", account=account)
-                (user,) = c.fetchone()
+        try:
+            found = get_store().resolve(account)
+        except DATABASE_ERRORS:
+            return login_from_snapshot(None, account, provider)
+        if not found:
+            return render_template("choose-username.html", account=account)
+        user = found[0]
 
     if not username_valid(user):
         return "username must use only ascii letters, numbers and underscores.", 400
@@ -196,77 +395,116 @@ def callback(provider, account):
 
     # here we'll have a valid username and one account that has just been authorized
     # link them up
-    with pg:
-        with pg.cursor() as c:
-            c.execute(
-                "SELECT user_id, account FROM accounts "
-                "WHERE (user_id = %s OR account = %s)",
-                (user, account),
-            )
-
-            if c.rowcount == 0:
-                # user is new, register
-                c.execute(
-                    "INSERT INTO accounts (user_id, account) " "VALUES (%s, %s)",
-                    (user, account),
-                )
-                return return_user_token(user)
-
-            else:
-                # this user is already registered
-                alternatives = []
-
-                # the user must authorize the new account
-                # using one of the his previous accounts
-                for r_user, r_account in c.fetchall():
-                    if r_account == account:
-                        if r_user == user:
-                            # this same account has been registered
-                            # so everything is fine (common)
-                            return return_user_token(user)
-                        else:
-                            # this account was registered with a
-                            # different user, let's see if the vistor
-                            # wants to login with his old username
-                            return render_template(
-                                "prompt_user.html",
-                                r_user=r_user,
-                                user=user,
-                                account=account,
-                            )
-                    elif r_account in session["authorized_accounts"]:
-                        # the visitor has already authorized with one
-                        # of his old accounts, so everything is fine
-                        c.execute(
-                            "INSERT INTO accounts (user_id, account) "
-                            "VALUES (%s, %s) ON CONFLICT DO NOTHING",
-                            (user, account),
-                        )
-                        return return_user_token(user)
-
-                    alternatives.append(r_account)
-
-                if len(alternatives) == 1:
-                    return redirect(
-                        app.config["SERVICE_URL"]
-                        + url_for(
-                            ".login_specific",
-                            redirect_uri=session.pop("redirect_uri", ""),
-                            user=user,
-                            account=alternatives[0],
-                            initial_account=account,
-                        )
-                    )
+    try:
+        db = get_store()
+        rows = db.related(user, account)
+
+        if not rows:
+            # user is new, register
+            remember(account, user, db.register(user, account))
+            g.accounts_changed = True
+            events.emit("registration", user=user, account=account, provider=provider)
+            return return_user_token(user)
+
+        # this user is already registered
+        alternatives = []
+
+        # the user must authorize the new account
+        # using one of the his previous accounts
+        for r_user, r_account, r_seq in rows:
+            if r_account == account:
+                if r_user == user:
+                    # this same account has been registered
+                    # so everything is fine (common)
+                    remember(account, user, r_seq)
+                    events.emit("login", user=user, account=account, provider=provider)
+                    return return_user_token(user)
                 else:
+                    # this account was registered with a
+                    # different user, let's see if the vistor
+                    # wants to login with his old username
                     return render_template(
-                        "alternatives.html",
-                        alternatives=alternatives,
-                        user=user,
-                        account=account,
+                        "prompt_user.html", r_user=r_user, user=user, account=account
                     )
+            elif r_account in session["authorized_accounts"]:
+                # the visitor has already authorized with one
+                # of his old accounts, so everything is fine
+                seq = db.link(user, account)
+                if seq:
+                    remember(account, user, seq)
+                g.accounts_changed = True
+                events.emit(
+                    "link",
+                    user=user,
+                    account=account,
+                    provider=provider,
+                    authorized_by=r_account,
+                )
+                return return_user_token(user)
+
+            alternatives.append(r_account)
+    except DATABASE_ERRORS:
+        return login_from_snapshot(user, account, provider)
+
+    if len(alternatives) == 1:
+        return redirect(
+            current_app.config["SERVICE_URL"]
+            + url_for(
+                ".login_specific",
+                redirect_uri=session.pop("redirect_uri", ""),
+                user=user,
+                account=alternatives[0],
+                initial_account=account,
+            )
+        )
+    else:
+        return render_template(
+            "alternatives.html", alternatives=alternatives, user=user, account=account
+        )
+
+
+def remembered_user(account):
+    try:
+        user, seq, checked_at = session["remembered"][account]
+    except (KeyError, TypeError, ValueError):
+        return None
+
+    if time.time() - checked_at > REMEMBER_FRESH_FOR:
+        # make sure the account is still theirs and hasn't been touched
+        # since we remembered it
+        try:
+            current = get_store().resolve(account)
+        except DATABASE_ERRORS:
+            return None
+
+        if current is None or tuple(current) != (user, seq):
+            del session["remembered"][account]
+            session.modified = True
+            return None
+        remember(account, user, seq)
+
+    return user
 
 
-@app.route("/redirect/<current_user>/to/<next_user>/with/<account>")
+def remember(account, user, seq):
+    # the session lives in redis and only its signed id goes to the browser,
+    # so visitors can't forge these
+    session.setdefault("remembered", {})[account] = [user, seq, time.time()]
+    session.modified = True
+
+
+def login_from_snapshot(user, account, provider):
+    # postgres is unreachable, but returning users whose account was already
+    # theirs in the local snapshot can still get a token
+    known = snapshot.resolve(account)
+    if not known or (user and known != user):
+        return unavailable("the database")
+
+    events.emit("login", user=known, account=account, provider=provider, stale=True)
+    return return_user_token(known)
+
+
+@bp.route("/redirect/<current_user>/to/<next_user>/with/<account>")
 def redirect_user_id(current_user, next_user, account):
     if session["account"] != account or session["user"] != current_user:
         return "wrong user/account, go to /login first", 403
@@ -275,11 +513,13 @@ def redirect_user_id(current_user, next_user, account):
     session["authorized"].append(account)
     session.modified = True
 
-    return redirect(app.config["SERVICE_URL"] + url_for(".authorized"))
+    return redirect(current_app.config["SERVICE_URL"] + url_for(".authorized"))
 
 
-@app.route("/link/<account>/on/<user>/with/<alt_account>", methods=["POST"])
+@bp.route("/link/<account>/on/<user>/with/<alt_account>", methods=["POST"])
 def link(account, user, alt_account):
+    account = normalize_account(account)
+    alt_account = normalize_account(alt_account)
     if (
         session["account"] != account
         or session["user"] != user
@@ -287,79 +527,250 @@ def link(account, user, alt_account):
     ):
         return "wrong user/account, go to /login first", 403
 
-    with pg:
-        with pg.cursor() as c:
-            c.execute(
-                "INSERT INTO accounts (account, user_id) "
-                "VALUES (%s, %s) "
-                "ON CONFLICT (account) "
-                "DO UPDATE SET user_id = %s",
-                (account, user, user),
-            )
+    get_store().move(user, account)
+    g.accounts_changed = True
 
+    events.emit("link", user=user, account=account, authorized_by=alt_account)
     return return_user_token(user)
 
 
-@app.route("/verify/<token>", methods=["POST"])
+@bp.route("/verify/<token>", methods=["POST"])
 def verify(token):
     try:
-        decoded = jwt.decode(token, app.config["PUBLIC_KEY"], algorithms="RS256")
+        decoded = jwt.decode(
+            token, current_app.config["PUBLIC_KEY"], algorithms="RS256"
+        )
         return jsonify(decoded)
-    except jwt.exceptions.InvalidAlgorithmError:
+    except (jwt.exceptions.InvalidAlgorithmError, jwt.exceptions.ExpiredSignatureError):
         return abort(400)
 
 
-@app.route("/lookup/<name>")
+@bp.route("/lookup/<name>")
 def lookup(name):
-    return jsonify(_lookup(name))
+    name = normalize_account(name)
+    if not name:
+        return jsonify({"error": "invalid"})
+
+    try:
+        found = _lookup(name)
+    except DATABASE_ERRORS:
+        return stale_lookup(name)
+
+    if not found:
+        return jsonify({"id": None, "type": account_type(name)})
+
+    # the document and its etag were built when the accounts were written,
+    # so here we just send the stored bytes
+    body, etag = found
+    resp = Response(body, mimetype="application/json")
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp.make_conditional(request)
 
 
 def _lookup(name):
-    name = name.strip().lower()
-    if not name:
-        return {"error": "invalid"}
-
-    with pg:
-        with pg.cursor() as c:
-            c.execute(
-                "SELECT user_id, account FROM accounts "
-                "WHERE user_id = ("
-                "SELECT user_id FROM accounts "
-                "WHERE user_id = %s OR account = %s "
-                "LIMIT 1"
-                ")",
-                (name, name),
-            )
+    return get_store().lookup(name)
 
-            rows = c.fetchall()
-            accs = [{"account": r[1], "type": account_type(r[1])} for r in rows]
 
-            if c.rowcount:
-                return {"id": rows[0][0], "accounts": accs}
-            else:
-                return {"id": None, "type": account_type(name)}
+def stale_lookup(name):
+    # postgres is unreachable, answer from the local snapshot and say how
+    # old it is
+    as_of = snapshot.as_of()
+    if as_of is None:
+        return unavailable("the database")
 
+    user = snapshot.lookup(name)
+    if user:
+        user["accounts"] = [
+            {"account": account, "type": account_type(account)}
+            for account in user["accounts"]
+        ]
+    else:
+        user = {"id": None, "type": account_type(name)}
 
-def return_user_token(user):
-    token = jwt.encode(
-        {"user": user, "role": "accountd_user"},
-        app.config["PRIVATE_KEY"],
-        algorithm="RS256",
+    user["stale"] = True
+    user["as_of"] = as_of
+    return jsonify(user)
+
+
+@bp.route("/changes")
+def changes():
+    try:
+        since = int(
+            request.headers.get("Last-Event-ID") or request.args.get("since", 0)
+        )
+        limit = int(request.args.get("limit", CHANGES_LIMIT))
+        limit = max(1, min(limit, CHANGES_LIMIT))
+    except ValueError:
+        return jsonify({"error": "invalid since or limit"}), 400
+
+    if (
+        "text/event-stream" in request.headers.get("Accept", "")
+        and current_app.config["CHANGES_MAX_STREAMS"]
+    ):
+        if not open_stream():
+            resp = jsonify({"error": "too many streams, poll instead"})
+            resp.status_code = 503
+            resp.headers["Retry-After"] = str(CHANGES_POLL_INTERVAL)
+            return resp
+
+        resp = Response(
+            stream_changes(since),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+        resp.call_on_close(close_stream)
+        return resp
+
+    rows = _changes(since, limit)
+    return jsonify(
+        {
+            "changes": rows,
+            "next": rows[-1]["seq"] if rows else since,
+            "more": len(rows) == limit,
+        }
     )
 
+
+_streams = 0
+_streams_lock = threading.Lock()
+
+
+def open_stream():
+    global _streams
+    with _streams_lock:
+        if _streams >= current_app.config["CHANGES_MAX_STREAMS"]:
+            return False
+        _streams += 1
+        return True
+
+
+def close_stream():
+    global _streams
+    with _streams_lock:
+        _streams -= 1
+
+
+def stream_changes(since):
+    # each stream is capped in duration, clients reconnect with the
+    # Last-Event-ID header and resume from where they were
+    deadline = time.time() + CHANGES_STREAM_DURATION
+    pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(CHANGES_CHANNEL)
+
+    try:
+        while time.time() < deadline:
+            rows = _changes(since, CHANGES_LIMIT)
+            for row in rows:
+                since = row["seq"]
+                yield "id: {}\ndata: {}\n\n".format(since, json.dumps(row))
+
+            if len(rows) == CHANGES_LIMIT:
+                continue
+
+            # wait until someone writes to the accounts table
+            if not pubsub.get_message(timeout=CHANGES_POLL_INTERVAL):
+                yield ": keepalive\n\n"
+    finally:
+        pubsub.close()
+
+
+def _changes(since, limit):
+    return [
+        {
+            "seq": seq,
+            "id": user_id,
+            "account": account,
+            "type": account_type(account),
+        }
+        for seq, user_id, account in get_store().changes(since, limit)
+    ]
+
+
+@bp.after_request
+def publish_changes(resp):
+    # only announced after the view returns, when the write was committed
+    if g.get("accounts_changed"):
+        get_redis().publish(CHANGES_CHANNEL, "1")
+    return resp
+
+
+@bp.route("/search")
+def search():
+    q = normalize_account(request.args.get("q", ""))
+    if len(q) < 2:
+        return jsonify({"error": "query must have at least 2 characters"}), 400
+
+    try:
+        limit = int(request.args.get("limit", SEARCH_LIMIT))
+        limit = max(1, min(limit, SEARCH_LIMIT))
+    except ValueError:
+        return jsonify({"error": "invalid limit"}), 400
+
+    # hot prefixes are served from redis for a few seconds
+    key = "search:{}:{}".format(limit, q)
+    redis = get_redis()
+    cached = redis.get(key)
+    if cached:
+        resp = make_response(cached)
+        resp.headers["Content-Type"] = "application/json"
+        return resp
+
+    body = json.dumps({"results": _search(q, limit)})
+    redis.setex(key, SEARCH_CACHE_TTL, body)
+
+    resp = make_response(body)
+    resp.headers["Content-Type"] = "application/json"
+    return resp
+
+
+def _search(q, limit):
+    return [
+        {"id": user_id, "account": account, "type": account_type(account)}
+        for user_id, account in get_store().search(q, limit)
+    ]
+
+
+def return_user_token(user):
+    payload = {"user": user, "role": "accountd_user"}
+
     redirect_uri = session.pop("redirect_uri", "")
+    client = clients.find(redirect_uri) if redirect_uri else None
+    if client and client.token_lifetime:
+        payload["exp"] = int(time.time()) + client.token_lifetime
+
+    if "exp" in payload:
+        token = jwt.encode(
+            payload, current_app.config["PRIVATE_KEY"], algorithm="RS256"
+        )
+    else:
+        token = signed_token(user, current_app.config["PRIVATE_KEY"])
+
     if redirect_uri:
         # pass response to external caller
         u = parse.urlparse(redirect_uri)
+        events.emit("token", user=user, client=u.netloc)
         qs = parse.parse_qs(u.query)
         qs["token"] = token
         back = u.scheme + "://" + u.netloc + u.path + "?" + parse.urlencode(qs)
         return redirect(back)
 
+    events.emit("token", user=user)
     resp = make_response(token)
     resp.headers["Content-Type"] = "text/plain"
     return resp
 
 
+@functools.lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def signed_token(user, private_key):
+    # RS256 signatures are deterministic, so tokens without an expiration
+    # can be signed once per user
+    payload = {"user": user, "role": "accountd_user"}
+    return jwt.encode(payload, private_key, algorithm="RS256")
+
+
+app = create_app()
+
+
 if __name__ == "__main__":
     app.run(debug=True, host="0.0.0.0", port=16725)
@@ -0,0 +1,29 @@
+try:
+    from .helpers import token_urlsafe
+    from .connections import get_redis
+except SystemError:
+    from helpers import token_urlsafe
+    from connections import get_redis
+
+# nonces live in redis so a login can start on one node and finish on
+# another, and each of them can only be used once
+TTL = 600
+
+
+def issue(kind, value="1", ttl=TTL):
+    nonce = token_urlsafe(24)
+    get_redis().set("nonce:{}:{}".format(kind, nonce), value, ex=ttl)
+    return nonce
+
+
+def consume(kind, nonce):
+    """Returns the value stored with the nonce, or None if it isn't valid."""
+    if not nonce:
+        return None
+
+    key = "nonce:{}:{}".format(kind, nonce)
+    pipe = get_redis().pipeline()
+    pipe.get(key)
+    pipe.delete(key)
+    value, deleted = pipe.execute()
+    return value if deleted else None
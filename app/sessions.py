@@ -0,0 +1,104 @@
+from itsdangerous import Signer, BadSignature
+from werkzeug.datastructures import CallbackDict
+from flask.sessions import SessionInterface, SessionMixin
+from flask.json.tag import TaggedJSONSerializer
+
+try:
+    from .helpers import token_urlsafe
+    from .connections import get_redis
+except SystemError:
+    from helpers import token_urlsafe
+    from connections import get_redis
+
+# sessions are kept in redis and the cookie only carries a signed random id,
+# so any node can continue a login started by another. the id is signed
+# with SECRET_KEY and also accepted if signed with one of OLD_SECRET_KEYS,
+# which lets keys be rotated without logging everybody out.
+TTL = 60 * 60 * 24
+SALT = "accountd-session"
+
+serializer = TaggedJSONSerializer()
+
+
+class RedisSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.replaced_sid = None
+
+    def regenerate(self):
+        """
+        Moves the data to a new id, so whoever knew the old one (e.g. from a
+        cookie planted before login) doesn't share what comes after.
+        """
+        if self.replaced_sid is None and not self.new:
+            self.replaced_sid = self.sid
+        self.sid = token_urlsafe(32)
+        self.modified = True
+
+
+class RedisSessionInterface(SessionInterface):
+    def signers(self, app):
+        keys = [app.secret_key] + app.config["OLD_SECRET_KEYS"]
+        return [Signer(key, salt=SALT) for key in keys if key]
+
+    def open_session(self, app, request):
+        signers = self.signers(app)
+        if not signers:
+            return None
+
+        cookie = request.cookies.get(app.config["SESSION_COOKIE_NAME"])
+        if cookie:
+            for i, signer in enumerate(signers):
+                try:
+                    sid = signer.unsign(cookie).decode("ascii")
+                except BadSignature:
+                    continue
+
+                data = get_redis().get("session:" + sid)
+                if data is None:
+                    break
+                session = RedisSession(serializer.loads(data), sid=sid)
+                if i > 0:
+                    # signed with an old key, sign it again with the current one
+                    session.modified = True
+                return session
+
+        return RedisSession(sid=token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = app.config["SESSION_COOKIE_NAME"]
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.replaced_sid:
+            get_redis().delete("session:" + session.replaced_sid)
+
+        if not session:
+            if session.modified and not session.new:
+                get_redis().delete("session:" + session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        response.vary.add("Cookie")
+        if not session.modified:
+            return
+
+        get_redis().set(
+            "session:" + session.sid, serializer.dumps(dict(session)), ex=TTL
+        )
+        response.set_cookie(
+            name,
+            self.signers(app)[0].sign(session.sid.encode("ascii")).decode("ascii"),
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
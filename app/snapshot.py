@@ -0,0 +1,224 @@
+import os
+import json
+import time
+import fcntl
+import sqlite3
+import threading
+
+import psycopg2
+
+try:
+    from .connections import CONNECT_TIMEOUT
+except SystemError:
+    from connections import CONNECT_TIMEOUT
+
+# a copy of the accounts mapping kept in a local sqlite file, so lookups and
+# logins of returning users keep working while postgres is unreachable. it
+# is refreshed incrementally by following accounts.seq, the same sequence
+# that backs /changes, so each refresh only reads what was written since.
+REFRESH_INTERVAL = 5
+BATCH_SIZE = 5000
+
+# errors that mean we couldn't talk to postgres at all
+DATABASE_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+  account TEXT PRIMARY KEY,
+  user_id TEXT NOT NULL,
+  seq INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS accounts_user_id ON accounts (user_id, seq);
+CREATE TABLE IF NOT EXISTS clients (client_id TEXT PRIMARY KEY, row TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+"""
+
+_config = {}
+_local = threading.local()
+_pid = None
+_lock = {}
+
+
+def init_app(app):
+    _config["DATABASE_URL"] = app.config["DATABASE_URL"]
+    _config["SNAPSHOT_PATH"] = app.config["SNAPSHOT_PATH"]
+    # there's nothing to copy unless accounts are kept in postgres
+    _config["SNAPSHOT_INTERVAL"] = (
+        app.config["SNAPSHOT_INTERVAL"] if app.config["STORE"] == "postgres" else 0
+    )
+
+
+def _db():
+    # sqlite connections can't be shared between threads or processes, and
+    # the refresher gets its own postgres connection so it never joins a
+    # transaction a request has open
+    if getattr(_local, "pid", None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.db = None
+        _local.pg = None
+
+    if _local.db is None:
+        db = sqlite3.connect(_config["SNAPSHOT_PATH"], timeout=10)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(SCHEMA)
+        _local.db = db
+    return _local.db
+
+
+def _pg():
+    if _local.pg is None or _local.pg.closed:
+        _local.pg = psycopg2.connect(
+            _config["DATABASE_URL"], connect_timeout=CONNECT_TIMEOUT
+        )
+    return _local.pg
+
+
+def _meta(db, key):
+    row = db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def refresh():
+    """Copies the accounts written since the last refresh. Returns how many."""
+    db = _db()
+    last = _meta(db, "seq") or 0
+    copied = 0
+
+    pg = _pg()
+
+    # registered clients are few, so they're copied whole every time
+    with pg:
+        with pg.cursor() as c:
+            c.execute(
+                "SELECT client_id, site_name, redirect_prefixes, "
+                "token_lifetime, providers FROM clients"
+            )
+            clients = c.fetchall()
+    with db:
+        db.execute("DELETE FROM clients")
+        db.executemany(
+            "INSERT INTO clients (client_id, row) VALUES (?, ?)",
+            [(row[0], json.dumps(row)) for row in clients],
+        )
+
+    while True:
+        with pg:
+            with pg.cursor() as c:
+                c.execute(
+                    "SELECT account, user_id, seq FROM accounts "
+                    "WHERE seq > %s ORDER BY seq LIMIT %s",
+                    (last, BATCH_SIZE),
+                )
+                rows = c.fetchall()
+
+        with db:
+            # a row, or the seq we're at, is never replaced by an older one,
+            # in case some other process is copying the same file
+            db.executemany(
+                "INSERT OR REPLACE INTO accounts (account, user_id, seq) "
+                "SELECT ?, ?, ? WHERE NOT EXISTS ("
+                "  SELECT 1 FROM accounts WHERE account = ? AND seq >= ?"
+                ")",
+                [(a, u, seq, a, seq) for a, u, seq in rows],
+            )
+            if rows:
+                last = rows[-1][2]
+                db.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('seq', "
+                    "  max(?, coalesce((SELECT value FROM meta WHERE key = 'seq'), 0)))",
+                    (last,),
+                )
+            if len(rows) < BATCH_SIZE:
+                db.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('as_of', ?)",
+                    (int(time.time()),),
+                )
+
+        copied += len(rows)
+        if len(rows) < BATCH_SIZE:
+            return copied
+
+
+def as_of():
+    """When the snapshot was last fully caught up, or None if it never was."""
+    return _meta(_db(), "as_of")
+
+
+def resolve(account):
+    row = (
+        _db()
+        .execute("SELECT user_id FROM accounts WHERE account = ?", (account,))
+        .fetchone()
+    )
+    return row[0] if row else None
+
+
+def lookup(name):
+    """Same document as /lookup, built from the snapshot."""
+    db = _db()
+    user = resolve(name)
+    if not user:
+        row = db.execute(
+            "SELECT user_id FROM accounts WHERE user_id = ? LIMIT 1", (name,)
+        ).fetchone()
+        if not row:
+            return None
+        (user,) = row
+
+    rows = db.execute(
+        "SELECT account FROM accounts WHERE user_id = ? ORDER BY seq", (user,)
+    ).fetchall()
+    return {"id": user, "accounts": [account for (account,) in rows]}
+
+
+def clients():
+    """The registered clients as of the last refresh, or None if it never ran."""
+    if as_of() is None:
+        return None
+    rows = _db().execute("SELECT row FROM clients").fetchall()
+    return [tuple(json.loads(row)) for (row,) in rows]
+
+
+def clear():
+    db = _db()
+    with db:
+        db.execute("DELETE FROM accounts")
+        db.execute("DELETE FROM clients")
+        db.execute("DELETE FROM meta")
+
+
+def start():
+    """Starts refreshing in the background, once per process."""
+    global _pid
+    if _pid == os.getpid() or not _config["SNAPSHOT_INTERVAL"]:
+        return
+    _pid = os.getpid()
+    threading.Thread(target=_run, name="snapshot-refresher", daemon=True).start()
+
+
+def _holds_lock():
+    # every worker runs a refresher, but only the one holding the lock on
+    # the file refreshes it; when that process is gone another takes over
+    if _lock.get("pid") != os.getpid():
+        _lock["pid"] = os.getpid()
+        _lock["file"] = open(_config["SNAPSHOT_PATH"] + ".lock", "w")
+        _lock["held"] = False
+
+    if not _lock["held"]:
+        try:
+            fcntl.flock(_lock["file"], fcntl.LOCK_EX | fcntl.LOCK_NB)
+            _lock["held"] = True
+        except OSError:
+            pass
+    return _lock["held"]
+
+
+def _run():
+    while True:
+        try:
+            if _holds_lock():
+                refresh()
+        except Exception:
+            # postgres is away, the snapshot just gets older
+            pass
+        time.sleep(_config["SNAPSHOT_INTERVAL"])
@@ -0,0 +1,459 @@
+import re
+import json
+import bisect
+import hashlib
+import threading
+from collections import defaultdict
+
+import psycopg2
+from psycopg2.errorcodes import UNIQUE_VIOLATION
+
+try:
+    from .helpers import account_type
+    from .connections import get_pg
+except SystemError:
+    from helpers import account_type
+    from connections import get_pg
+
+# pg_trgm's default similarity threshold, used by the `%` operator
+SIMILARITY_THRESHOLD = 0.3
+
+_config = {}
+_stores = {}
+
+
+class AccountExists(Exception):
+    """Raised by register() when the account already belongs to someone."""
+
+
+def init_app(app):
+    if app.config["STORE"] not in STORES:
+        raise ValueError("unknown STORE {}".format(app.config["STORE"]))
+    _config["STORE"] = app.config["STORE"]
+
+
+def get_store():
+    kind = _config["STORE"]
+    try:
+        return _stores[kind]
+    except KeyError:
+        store = _stores[kind] = STORES[kind]()
+        return store
+
+
+class AccountStore(object):
+    """
+    Where accounts, the users they belong to and the registered clients
+    are kept. Every write gives the account a new seq, which orders the
+    /changes feed and works as the account's version.
+    """
+
+    def resolve(self, account):
+        """Returns (user, seq) for the account, or None."""
+        raise NotImplementedError
+
+    def related(self, user, account):
+        """Returns (user, account, seq) for all accounts of `user` and for `account`."""
+        raise NotImplementedError
+
+    def register(self, user, account):
+        """
+        Adds an account that doesn't exist yet and returns its seq, raises
+        AccountExists if it does.
+        """
+        raise NotImplementedError
+
+    def link(self, user, account):
+        """Adds the account unless it already exists, returns its seq or None."""
+        raise NotImplementedError
+
+    def move(self, user, account):
+        """Adds the account or gives it to `user`, returns its seq."""
+        raise NotImplementedError
+
+    def lookup(self, name):
+        """Returns the /lookup document and its etag for a username or account."""
+        return self.lookup_many([name]).get(name)
+
+    def lookup_many(self, names):
+        """Returns {name: (document, etag)} for the names that were found."""
+        raise NotImplementedError
+
+    def changes(self, since, limit):
+        """Returns (seq, user, account) for accounts written after `since`."""
+        raise NotImplementedError
+
+    def search(self, q, limit):
+        """Returns (user, account) for prefix matches first, then similar ones."""
+        raise NotImplementedError
+
+    def clients(self):
+        """
+        Returns (client_id, site_name, redirect_prefixes, token_lifetime,
+        providers) for every registered client.
+        """
+        raise NotImplementedError
+
+    def save_client(
+        self, client_id, redirect_prefixes, site_name, token_lifetime, providers
+    ):
+        raise NotImplementedError
+
+    def delete_client(self, client_id):
+        """Returns whether there was such a client."""
+        raise NotImplementedError
+
+
+class PostgresStore(AccountStore):
+    def resolve(self, account):
+        pg = get_pg()
+        with pg:
+            with pg.cursor() as c:
+                c.execute(
+                    "SELECT user_id, seq FROM accounts WHERE account = %s", (account,)
+                )
+                return c.fetchone()
+
+    def related(self, user, account):
+        pg = get_pg()
+        with pg:
+            with pg.cursor() as c:
+                c.execute(
+                    "SELECT user_id, account, seq FROM accounts "
+                    "WHERE (user_id = %s OR account = %s)",
+                    (user, account),
+                )
+                return c.fetchall()
+
+    def register(self, user, account):
+        pg = get_pg()
+        try:
+            with pg:
+                with pg.cursor() as c:
+                    c.execute(
+                        "INSERT INTO accounts (user_id, account) "
+                        "VALUES (%s, %s) RETURNING seq",
+                        (user, account),
+                    )
+                    return c.fetchone()[0]
+        except psycopg2.IntegrityError as e:
+            if e.pgcode != UNIQUE_VIOLATION:
+                raise
+            raise AccountExists(account)
+
+    def link(self, user, account):
+        pg = get_pg()
+        with pg:
+            with pg.cursor() as c:
+                c.execute(
+                    "INSERT INTO accounts (user_id, account) "
+                    "VALUES (%s, %s) ON CONFLICT DO NOTHING "
+                    "RETURNING seq",
+                    (user, account),
+                )
+                row = c.fetchone()
+                return row[0] if row else None
+
+    def move(self, user, account):
+        pg = get_pg()
+        with pg:
+            with pg.cursor() as c:
+                c.execute(
+                    "INSERT INTO accounts (account, user_id) "
+                    "VALUES (%s, %s) "
+                    "ON CONFLICT (account) "
+                    "DO UPDATE SET user_id = %s "
+                    "RETURNING seq",
+                    (account, user, user),
+                )
+                return c.fetchone()[0]
+
+    def lookup_many(self, names):
+        # the documents are built by a trigger whenever accounts change
+        pg = get_pg()
+        with pg:
+            with pg.cursor() as c:
+                c.execute(
+                    "SELECT name, body, etag FROM lookups WHERE name = ANY(%s)",
+                    (list(names),),
+                )
+                return {name: (body, etag) for name, body, etag in c.fetchall()}
+
+    def changes(self, since, limit):
+        pg = get_pg()
+        with pg:
+            with pg.cursor() as c:
+                c.execute(
+                    "SELECT seq, user_id, account FROM accounts "
+                    "WHERE seq > %s ORDER BY seq LIMIT %s",
+                    (since, limit),
+                )
+                return c.fetchall()
+
+    def search(self, q, limit):
+        prefix = q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+        # prefix hits come straight off the text_pattern_ops btrees, each
+        # side reading at most `limit` rows in index order, and are ranked
+        # by whichever of user_id or account matched
+        pg = get_pg()
+        with pg:
+            with pg.cursor() as c:
+                c.execute(
+                    "SELECT user_id, account FROM ("
+                    "  (SELECT user_id, account, user_id AS key FROM accounts"
+                    "   WHERE user_id LIKE %(prefix)s"
+                    "   ORDER BY user_id USING ~<~, account USING ~<~"
+                    "   LIMIT %(limit)s)"
+                    "  UNION ALL"
+                    "  (SELECT user_id, account, account FROM accounts"
+                    "   WHERE account LIKE %(prefix)s"
+                    "   ORDER BY account USING ~<~"
+                    "   LIMIT %(limit)s)"
+                    ") AS hits "
+                    "GROUP BY user_id, account "
+                    'ORDER BY min(key COLLATE "C"), '
+                    'user_id COLLATE "C", account COLLATE "C" '
+                    "LIMIT %(limit)s",
+                    {"prefix": prefix, "limit": limit},
+                )
+                rows = c.fetchall()
+                if len(rows) == limit:
+                    return rows
+
+                # the trigram pass only fills what's left. each side is a
+                # knn scan on its gist index that stops after `limit` rows,
+                # never sorting every match; when we get here every prefix
+                # hit is in `rows`, so that's enough to fill the page
+                c.execute(
+                    "SET LOCAL pg_trgm.similarity_threshold = %s",
+                    (SIMILARITY_THRESHOLD,),
+                )
+                c.execute(
+                    "SELECT user_id, account FROM ("
+                    "  (SELECT user_id, account, user_id <-> %(q)s AS distance"
+                    "   FROM accounts WHERE user_id %% %(q)s"
+                    "   ORDER BY user_id <-> %(q)s LIMIT %(limit)s)"
+                    "  UNION ALL"
+                    "  (SELECT user_id, account, account <-> %(q)s"
+                    "   FROM accounts WHERE account %% %(q)s"
+                    "   ORDER BY account <-> %(q)s LIMIT %(limit)s)"
+                    ") AS near "
+                    "WHERE NOT (user_id LIKE %(prefix)s OR account LIKE %(prefix)s) "
+                    "GROUP BY user_id, account "
+                    'ORDER BY min(distance), user_id COLLATE "C", account COLLATE "C" '
+                    "LIMIT %(rest)s",
+                    {
+                        "q": q,
+                        "prefix": prefix,
+                        "limit": limit,
+                        "rest": limit - len(rows),
+                    },
+                )
+                return rows + c.fetchall()
+
+    def clients(self):
+        pg = get_pg()
+        with pg:
+            with pg.cursor() as c:
+                c.execute(
+                    "SELECT client_id, site_name, redirect_prefixes, "
+                    "token_lifetime, providers FROM clients"
+                )
+                return c.fetchall()
+
+    def save_client(
+        self, client_id, redirect_prefixes, site_name, token_lifetime, providers
+    ):
+        pg = get_pg()
+        with pg:
+            with pg.cursor() as c:
+                c.execute(
+                    "INSERT INTO clients "
+                    "(client_id, site_name, redirect_prefixes, token_lifetime, providers) "
+                    "VALUES (%s, %s, %s, %s, %s) "
+                    "ON CONFLICT (client_id) DO UPDATE SET "
+                    "site_name = excluded.site_name, "
+                    "redirect_prefixes = excluded.redirect_prefixes, "
+                    "token_lifetime = excluded.token_lifetime, "
+                    "providers = excluded.providers",
+                    (
+                        client_id,
+                        site_name,
+                        list(redirect_prefixes),
+                        token_lifetime,
+                        list(providers) if providers else None,
+                    ),
+                )
+
+    def delete_client(self, client_id):
+        pg = get_pg()
+        with pg:
+            with pg.cursor() as c:
+                c.execute("DELETE FROM clients WHERE client_id = %s", (client_id,))
+                return c.rowcount > 0
+
+
+class MemoryStore(AccountStore):
+    """
+    Keeps everything in dicts, for tests and for benchmarks that should
+    leave the database out. Each process has its own copy.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._seq = 0
+            self._accounts = {}  # account -> (user, seq)
+            self._users = defaultdict(set)  # user -> accounts
+            self._by_seq = {}  # seq -> account, only the current ones
+            self._seqs = []  # every seq ever given, in order
+            self._documents = {}  # user -> (document, etag)
+            self._clients = {}
+
+    def resolve(self, account):
+        return self._accounts.get(account)
+
+    def related(self, user, account):
+        with self._lock:
+            accounts = set(self._users.get(user, ()))
+            if account in self._accounts:
+                accounts.add(account)
+            rows = [(self._accounts[a][0], a, self._accounts[a][1]) for a in accounts]
+            return sorted(rows, key=lambda row: row[2])
+
+    def register(self, user, account):
+        with self._lock:
+            if account in self._accounts:
+                raise AccountExists(account)
+            return self._put(user, account)
+
+    def link(self, user, account):
+        with self._lock:
+            if account in self._accounts:
+                return None
+            return self._put(user, account)
+
+    def move(self, user, account):
+        with self._lock:
+            return self._put(user, account)
+
+    def _put(self, user, account):
+        previous = self._accounts.get(account)
+        if previous:
+            old_user, old_seq = previous
+            del self._by_seq[old_seq]
+            self._users[old_user].discard(account)
+
+        self._seq += 1
+        self._accounts[account] = (user, self._seq)
+        self._users[user].add(account)
+        self._by_seq[self._seq] = account
+        self._seqs.append(self._seq)
+
+        if previous and previous[0] != user:
+            self._build(previous[0])
+        self._build(user)
+        return self._seq
+
+    def _build(self, user):
+        # the same document the lookups trigger builds in postgres
+        accounts = sorted(self._users.get(user, ()), key=lambda a: self._accounts[a][1])
+        if not accounts:
+            self._users.pop(user, None)
+            self._documents.pop(user, None)
+            return
+
+        document = json.dumps(
+            {
+                "accounts": [{"account": a, "type": account_type(a)} for a in accounts],
+                "id": user,
+            }
+        )
+        etag = hashlib.md5(document.encode("utf-8")).hexdigest()
+        self._documents[user] = (document, etag)
+
+    def lookup_many(self, names):
+        found = {}
+        with self._lock:
+            for name in names:
+                if name in self._accounts:
+                    user = self._accounts[name][0]
+                else:
+                    user = name
+                if user in self._documents:
+                    found[name] = self._documents[user]
+        return found
+
+    def changes(self, since, limit):
+        rows = []
+        with self._lock:
+            start = bisect.bisect_right(self._seqs, since)
+            for seq in self._seqs[start:]:
+                account = self._by_seq.get(seq)
+                if account is None:
+                    # the account was written again later
+                    continue
+                rows.append((seq, self._accounts[account][0], account))
+                if len(rows) == limit:
+                    break
+        return rows
+
+    def search(self, q, limit):
+        with self._lock:
+            accounts = [(user, a) for a, (user, _) in self._accounts.items()]
+
+        # the same order PostgresStore gives: prefix hits by the text that
+        # matched, then similar ones by score
+        hits, similar = [], []
+        for user, account in accounts:
+            keys = [text for text in (user, account) if text.startswith(q)]
+            if keys:
+                hits.append((min(keys), user, account))
+                continue
+            score = max(similarity(user, q), similarity(account, q))
+            if score >= SIMILARITY_THRESHOLD:
+                similar.append((-score, user, account))
+        hits.sort()
+        similar.sort()
+        return [(user, account) for _, user, account in (hits + similar)[:limit]]
+
+    def clients(self):
+        return list(self._clients.values())
+
+    def save_client(
+        self, client_id, redirect_prefixes, site_name, token_lifetime, providers
+    ):
+        self._clients[client_id] = (
+            client_id,
+            site_name,
+            list(redirect_prefixes),
+            token_lifetime,
+            list(providers) if providers else None,
+        )
+
+    def delete_client(self, client_id):
+        return self._clients.pop(client_id, None) is not None
+
+
+def trigrams(text):
+    # like pg_trgm: each word is padded with two spaces in front and one
+    # at the end before being split into trigrams
+    grams = set()
+    for word in re.findall(r"[a-z0-9]+", text.lower()):
+        word = "  " + word + " "
+        grams.update(word[i : i + 3] for i in range(len(word) - 2))
+    return grams
+
+
+def similarity(a, b):
+    a, b = trigrams(a), trigrams(b)
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+STORES = {"postgres": PostgresStore, "memory": MemoryStore}
@@ -1,13 +1,8 @@
-from flask import redirect, url_for, g, session
-
-try:
-    from .main import app
-except SystemError:
-    from main import app
+from flask import current_app, redirect, url_for, g, session
 
 
 def handle():
-    callback = app.config["SERVICE_URL"] + url_for(".callback", provider="test")
+    callback = current_app.config["SERVICE_URL"] + url_for(".callback", provider="test")
 
     if hasattr(g, "account"):
         session["test:account"] = g.account
@@ -17,4 +12,4 @@ def handle():
 
 def callback():
     account = session.pop("test:account", "anything@test")
-    return account if app.config["DEBUG"] or app.testing else None
+    return account if current_app.config["DEBUG"] or current_app.testing else None
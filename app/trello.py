@@ -3,12 +3,12 @@ from urllib.parse import urlparse, parse_qsl, urlencode
 
 import oauth2 as oauth
 import requests
-from flask import redirect, url_for, request, session
+from flask import current_app, redirect, url_for, request, session
 
 try:
-    from .main import app
+    from .breaker import guard, hedged, TIMEOUT
 except SystemError:
-    from main import app
+    from breaker import guard, hedged, TIMEOUT
 
 consumer_key = os.getenv("TRELLO_KEY")
 consumer_secret = os.getenv("TRELLO_SECRET")
@@ -19,20 +19,24 @@ authorize_url = "https://trello.com/1/OAuthAuthorizeToken"
 
 
 def redir():
-    return app.config["SERVICE_URL"] + url_for(".callback", provider="trello")
+    return current_app.config["SERVICE_URL"] + url_for(".callback", provider="trello")
 
 
 def handle():
     consumer = oauth.Consumer(consumer_key, consumer_secret)
-    client = oauth.Client(consumer)
+    client = oauth.Client(consumer, timeout=TIMEOUT)
 
-    resp, content = client.request(request_token_url, method="POST")
+    with guard("trello"):
+        resp, content = client.request(request_token_url, method="POST")
+        if resp.status >= 500:
+            raise Exception("Trello is failing with {}".format(resp.status))
     if resp.status != 200:
         raise Exception(
             "Trello has replied with {}: {}".format(
                 resp.status, content.decode("utf-8")
             )
         )
+
     data = dict(parse_qsl(content.decode("utf-8")))
     session["trl:rot"] = data["oauth_token"]
     session["trl:rst"] = data["oauth_token_secret"]
@@ -57,8 +61,11 @@ def callback():
     token.set_verifier(data["oauth_verifier"])
 
     consumer = oauth.Consumer(consumer_key, consumer_secret)
-    client = oauth.Client(consumer, token)
-    resp, content = client.request(access_token_url, "POST")
+    client = oauth.Client(consumer, token, timeout=TIMEOUT)
+    with guard("trello"):
+        resp, content = client.request(access_token_url, "POST")
+        if resp.status >= 500:
+            raise Exception("Trello is failing with {}".format(resp.status))
     if resp.status != 200:
         raise Exception(
             "Trello has replied with {}: {}".format(
@@ -68,15 +75,22 @@ def callback():
 
     access = dict(parse_qsl(content.decode("utf-8")))
 
-    client = oauth.Client(
-        consumer, oauth.Token(access["oauth_token"], access["oauth_token_secret"])
-    )
-
-    r = requests.get(
-        "https://api.trello.com/1/members/me?"
-        + urlencode(
-            {"key": consumer_key, "token": access["oauth_token"], "fields": "username"}
+    with guard("trello"):
+        r = hedged(
+            lambda: requests.get(
+                "https://api.trello.com/1/members/me?"
+                + urlencode(
+                    {
+                        "key": consumer_key,
+                        "token": access["oauth_token"],
+                        "fields": "username",
+                    }
+                ),
+                timeout=TIMEOUT,
+            ),
+            "trello",
         )
-    )
+        if r.status_code >= 500:
+            raise Exception("Trello is failing with {}".format(r.status_code))
 
     return r.json()["username"].lower() + "@trello"
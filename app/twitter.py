@@ -3,12 +3,12 @@ import json
 from urllib.parse import urlparse, parse_qsl, urlencode
 
 import oauth2 as oauth
-from flask import redirect, url_for, request, session
+from flask import current_app, redirect, url_for, request, session
 
 try:
-    from .main import app
+    from .breaker import guard, hedged, TIMEOUT
 except SystemError:
-    from main import app
+    from breaker import guard, hedged, TIMEOUT
 
 consumer_key = os.getenv("TWITTER_KEY")
 consumer_secret = os.getenv("TWITTER_SECRET")
@@ -20,16 +20,21 @@ user_url = "https://api.twitter.com/1.1/account/verify_credentials.json"
 
 
 def redir():
-    return app.config["SERVICE_URL"] + url_for(".callback", provider="twitter")
+    return current_app.config["SERVICE_URL"] + url_for(".callback", provider="twitter")
 
 
 def handle():
     consumer = oauth.Consumer(consumer_key, consumer_secret)
-    client = oauth.Client(consumer)
+    client = oauth.Client(consumer, timeout=TIMEOUT)
 
-    resp, content = client.request(
-        request_token_url, method="POST", body=urlencode({"oauth_callback": redir()})
-    )
+    with guard("twitter"):
+        resp, content = client.request(
+            request_token_url,
+            method="POST",
+            body=urlencode({"oauth_callback": redir()}),
+        )
+        if resp.status >= 500:
+            raise Exception("Twitter is failing with {}".format(resp.status))
     if resp.status != 200:
         raise Exception(
             "Twitter has replied with {}: {}".format(
@@ -53,8 +58,11 @@ def callback():
     token.set_verifier(data["oauth_verifier"])
 
     consumer = oauth.Consumer(consumer_key, consumer_secret)
-    client = oauth.Client(consumer, token)
-    resp, content = client.request(access_token_url, "POST")
+    client = oauth.Client(consumer, token, timeout=TIMEOUT)
+    with guard("twitter"):
+        resp, content = client.request(access_token_url, "POST")
+        if resp.status >= 500:
+            raise Exception("Twitter is failing with {}".format(resp.status))
     if resp.status != 200:
         raise Exception(
             "Twitter has replied with {}: {}".format(
@@ -64,10 +72,18 @@ def callback():
 
     access = dict(parse_qsl(content.decode("utf-8")))
 
-    client = oauth.Client(
-        consumer, oauth.Token(access["oauth_token"], access["oauth_token_secret"])
-    )
-    resp, content = client.request(user_url, "GET")
+    token = oauth.Token(access["oauth_token"], access["oauth_token_secret"])
+
+    # each attempt gets its own client, they're not thread-safe
+    with guard("twitter"):
+        resp, content = hedged(
+            lambda: oauth.Client(consumer, token, timeout=TIMEOUT).request(
+                user_url, "GET"
+            ),
+            "twitter",
+        )
+        if resp.status >= 500:
+            raise Exception("Twitter is failing with {}".format(resp.status))
     if resp.status != 200:
         return False
 
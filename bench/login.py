@@ -0,0 +1,74 @@
+"""
+Measures the latency of a returning user's login through the `test`
+provider, from /login to the token, with and without the identity
+remembered in their session. Run from the repository root with the same
+environment variables the app needs, e.g.:
+
+    env $(cat test/env | xargs) python bench/login.py
+
+With STORE=memory the accounts never leave the process, so what's left
+is the app's own overhead; with STORE=postgres it includes the queries.
+"""
+
+import time
+
+from app import main as accountd
+
+RUNS = 200
+ACCOUNT = "bench@test"
+
+
+def forget(client):
+    with client.session_transaction() as session:
+        session.pop("remembered", None)
+
+
+def measure(name, client, setup):
+    timings = []
+    for _ in range(RUNS):
+        setup()
+        start = time.perf_counter()
+        r = client.get("/login/with/" + ACCOUNT, follow_redirects=True)
+        timings.append((time.perf_counter() - start) * 1000)
+        assert r.status_code == 200, r.status_code
+
+    timings.sort()
+    print(
+        "{:>16}: median {:.2f}ms, p90 {:.2f}ms".format(
+            name, timings[len(timings) // 2], timings[int(len(timings) * 0.9)]
+        )
+    )
+
+
+def main():
+    app = accountd.app
+    app.testing = True
+
+    client = app.test_client()
+    r = client.get("/login/as/bench/with/" + ACCOUNT, follow_redirects=True)
+    assert r.status_code == 200, r.status_code
+
+    def full():
+        forget(client)
+        accountd.signed_token.cache_clear()
+
+    # the whole callback, with the token signed every time
+    measure("full", client, full)
+
+    # the whole callback, with the token already signed
+    measure("full, signed", client, lambda: forget(client))
+
+    # the binding in the session, within the freshness window
+    measure("remembered", client, lambda: None)
+
+    # the binding in the session, past the window, so it's checked
+    fresh_for = accountd.REMEMBER_FRESH_FOR
+    accountd.REMEMBER_FRESH_FOR = -1
+    try:
+        measure("remembered, old", client, lambda: None)
+    finally:
+        accountd.REMEMBER_FRESH_FOR = fresh_for
+
+
+if __name__ == "__main__":
+    main()
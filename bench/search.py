@@ -0,0 +1,95 @@
+"""
+Measures the latency of /search against a seeded accounts table. It
+REPLACES everything in `accounts`, so only point it at a scratch database:
+
+    env $(cat test/env | xargs) STORE=postgres python bench/search.py 10000000
+
+Queries are random prefixes of seeded usernames, long enough for the
+prefix pass to fill the page; `--fuzzy` also runs misspelled ones that need
+the trigram pass.
+"""
+
+import sys
+import time
+import random
+import hashlib
+
+from app import main as accountd
+from app.store import get_store
+from app.connections import get_pg
+
+RUNS = 2000
+LIMIT = 10
+
+
+def username(i):
+    # the same names seed() gives
+    return hashlib.md5(str(i).encode("ascii")).hexdigest()[: 6 + i % 7]
+
+
+def misspelled(rand, rows):
+    name = list(username(rand.randint(1, rows)))
+    name[rand.randrange(len(name))] = rand.choice("ghijk")
+    return "".join(name)
+
+
+def seed(rows):
+    pg = get_pg()
+    with pg:
+        with pg.cursor() as c:
+            # the seq and lookups triggers aren't needed to search
+            c.execute("TRUNCATE accounts, lookups")
+            c.execute("ALTER TABLE accounts DISABLE TRIGGER USER")
+            c.execute(
+                "INSERT INTO accounts (account, user_id, seq) "
+                "SELECT u || i || '@test', u, i FROM ("
+                "  SELECT i, substr(md5(i::text), 1, 6 + i %% 7) AS u"
+                "  FROM generate_series(1, %s) AS i"
+                ") AS s",
+                (rows,),
+            )
+            c.execute("ALTER TABLE accounts ENABLE TRIGGER USER")
+            c.execute("ANALYZE accounts")
+
+
+def measure(label, queries):
+    store = get_store()
+    timings = []
+    for q in queries:
+        start = time.perf_counter()
+        store.search(q, LIMIT)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    timings.sort()
+    print(
+        "{:>8}: median {:.2f}ms, p90 {:.2f}ms, p99 {:.2f}ms".format(
+            label,
+            timings[len(timings) // 2],
+            timings[int(len(timings) * 0.9)],
+            timings[int(len(timings) * 0.99)],
+        )
+    )
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if arg.isdigit()]
+    rows = int(args[0]) if args else 1000000
+    if accountd.app.config["STORE"] != "postgres":
+        sys.exit("run it with STORE=postgres")
+    print("seeding {} rows".format(rows))
+    seed(rows)
+
+    rand = random.Random(1)
+    hexdigits = "0123456789abcdef"
+    prefixes = [
+        "".join(rand.choice(hexdigits) for _ in range(rand.randint(2, 3)))
+        for _ in range(RUNS)
+    ]
+    measure("prefix", prefixes)
+
+    if "--fuzzy" in sys.argv:
+        measure("fuzzy", [misspelled(rand, rows) for _ in range(RUNS)])
+
+
+if __name__ == "__main__":
+    main()
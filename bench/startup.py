@@ -0,0 +1,45 @@
+"""
+Measures how long a fresh process takes from importing the app to serving
+its first request. Run from the repository root with the same environment
+variables the app needs, e.g.:
+
+    env $(cat test/env | xargs) python bench/startup.py
+"""
+
+import subprocess
+import sys
+import json
+
+RUNS = 10
+
+SCRIPT = """
+import json, time
+start = time.perf_counter()
+from app import app
+imported = time.perf_counter()
+r = app.test_client().get("/")
+assert r.status_code == 200, r.status_code
+served = time.perf_counter()
+print(json.dumps({"import": imported - start, "first_request": served - imported}))
+"""
+
+
+def main():
+    results = []
+    for _ in range(RUNS):
+        out = subprocess.check_output([sys.executable, "-c", SCRIPT])
+        results.append(json.loads(out.decode("utf-8").strip().splitlines()[-1]))
+
+    for key in ("import", "first_request"):
+        values = sorted(r[key] * 1000 for r in results)
+        print(
+            "{:>14}: min {:.1f}ms, median {:.1f}ms, max {:.1f}ms".format(
+                key, values[0], values[len(values) // 2], values[-1]
+            )
+        )
+    total = sorted((r["import"] + r["first_request"]) * 1000 for r in results)
+    print("{:>14}: median {:.1f}ms".format("total", total[len(total) // 2]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,15 @@
+# the app can be preloaded in the master process since it doesn't open any
+# connections at import time; each worker opens its own on first use.
+preload_app = True
+
+
+def post_fork(server, worker):
+    from app import connections
+
+    connections.reset()
+
+
+def worker_exit(server, worker):
+    from app import events
+
+    events.flush_on_exit()
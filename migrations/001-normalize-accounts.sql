@@ -0,0 +1,53 @@
+-- brings existing rows to the canonical form used by the application
+-- (lowercased, without surrounding whitespace or trailing dots).
+-- when the same canonical account is tied to more than one user nothing is
+-- changed: the conflicting rows are listed and the migration stops, so they
+-- can be sorted out by hand before running it again. duplicates that belong
+-- to the same user are merged, keeping the row that was already stored in
+-- canonical form, if any.
+BEGIN;
+
+DELETE FROM accounts WHERE user_id IS NULL;
+
+DO $$
+DECLARE
+  conflict record;
+  conflicts integer := 0;
+BEGIN
+  FOR conflict IN
+    SELECT rtrim(lower(trim(account)), '.') AS canonical,
+      string_agg(format('%L of %L', account, user_id), ', ' ORDER BY account) AS claims
+    FROM accounts
+    GROUP BY 1
+    HAVING count(DISTINCT user_id) > 1
+  LOOP
+    RAISE WARNING '% is claimed by %', conflict.canonical, conflict.claims;
+    conflicts := conflicts + 1;
+  END LOOP;
+
+  IF conflicts > 0 THEN
+    RAISE EXCEPTION '% accounts belong to more than one user once normalized', conflicts
+      USING HINT = 'delete or rename the rows listed above and run this again';
+  END IF;
+END
+$$;
+
+DELETE FROM accounts a
+USING accounts b
+WHERE a.account <> b.account
+  AND rtrim(lower(trim(a.account)), '.') = rtrim(lower(trim(b.account)), '.')
+  AND (
+    b.account = rtrim(lower(trim(b.account)), '.')
+    OR (a.account <> rtrim(lower(trim(a.account)), '.') AND a.account > b.account)
+  );
+
+UPDATE accounts
+SET account = rtrim(lower(trim(account)), '.')
+WHERE account <> rtrim(lower(trim(account)), '.');
+
+ALTER TABLE accounts ALTER COLUMN user_id SET NOT NULL;
+ALTER TABLE accounts ADD CONSTRAINT accounts_account_check
+  CHECK (account = rtrim(lower(trim(account)), '.'));
+CREATE INDEX accounts_user_id ON accounts (user_id);
+
+COMMIT;
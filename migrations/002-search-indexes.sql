@@ -0,0 +1,7 @@
+-- trigram indexes backing /search (prefix LIKE and fuzzy % matches)
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS accounts_user_id_trgm
+  ON accounts USING gin (user_id gin_trgm_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS accounts_account_trgm
+  ON accounts USING gin (account gin_trgm_ops);
@@ -0,0 +1,12 @@
+-- append-only log of logins and account links, filled by `flask consume-events`.
+-- monthly partitions are created by the consumer as needed.
+CREATE TABLE events (
+  id text NOT NULL, -- redis stream entry id
+  kind text NOT NULL,
+  user_id text,
+  account text,
+  provider text,
+  created_at timestamptz NOT NULL,
+  data jsonb,
+  PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
@@ -0,0 +1,26 @@
+-- change sequence backing /changes
+BEGIN;
+
+CREATE TABLE accounts_changes (last bigint NOT NULL);
+
+ALTER TABLE accounts ADD COLUMN seq bigint;
+UPDATE accounts SET seq = numbered.n
+FROM (SELECT account, row_number() OVER (ORDER BY ctid) AS n FROM accounts) AS numbered
+WHERE accounts.account = numbered.account;
+ALTER TABLE accounts ALTER COLUMN seq SET DEFAULT 0;
+ALTER TABLE accounts ALTER COLUMN seq SET NOT NULL;
+CREATE UNIQUE INDEX accounts_seq ON accounts (seq);
+
+INSERT INTO accounts_changes SELECT coalesce(max(seq), 0) FROM accounts;
+
+CREATE OR REPLACE FUNCTION accounts_next_seq() RETURNS trigger AS $$
+BEGIN
+  UPDATE accounts_changes SET last = last + 1 RETURNING last INTO NEW.seq;
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER accounts_next_seq BEFORE INSERT OR UPDATE ON accounts
+  FOR EACH ROW EXECUTE PROCEDURE accounts_next_seq();
+
+COMMIT;
@@ -0,0 +1,8 @@
+-- relying parties, managed with `flask clients`
+CREATE TABLE clients (
+  client_id text PRIMARY KEY,
+  site_name text,
+  redirect_prefixes text[] NOT NULL,
+  token_lifetime integer, -- seconds, tokens don't expire when null
+  providers text[] -- all providers are allowed when null
+);
@@ -0,0 +1,72 @@
+-- ready-to-send /lookup documents
+BEGIN;
+
+-- ready-to-send /lookup responses, one row per username and per account,
+-- rebuilt by a trigger in the same transaction as every write to accounts
+CREATE TABLE lookups (
+  name text PRIMARY KEY,
+  user_id text NOT NULL,
+  body text NOT NULL,
+  etag text NOT NULL
+);
+
+CREATE INDEX lookups_user_id ON lookups (user_id);
+
+-- same as helpers.account_type
+CREATE OR REPLACE FUNCTION account_type(account text) RETURNS text AS $$
+  SELECT CASE
+    WHEN position('@' in account) = 0 THEN
+      CASE
+        WHEN account ~ '^\+\d+$' THEN 'phone'
+        WHEN position('.' in account) > 0 THEN 'domain'
+      END
+    WHEN split_part(account, '@', 2) LIKE '%.%' THEN 'email'
+    ELSE split_part(account, '@', 2)
+  END
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION rebuild_lookups(uid text) RETURNS void AS $$
+DECLARE
+  doc text;
+BEGIN
+  DELETE FROM lookups WHERE user_id = uid;
+
+  SELECT json_build_object(
+    'accounts', json_agg(
+      json_build_object('account', account, 'type', account_type(account))
+      ORDER BY seq
+    ),
+    'id', uid
+  )::text INTO doc
+  FROM accounts WHERE user_id = uid HAVING count(*) > 0;
+
+  IF doc IS NULL THEN
+    RETURN;
+  END IF;
+
+  INSERT INTO lookups (name, user_id, body, etag)
+  SELECT DISTINCT name, uid, doc, md5(doc)
+  FROM (SELECT uid AS name UNION SELECT account FROM accounts WHERE user_id = uid) AS names
+  ON CONFLICT (name) DO UPDATE
+  SET user_id = excluded.user_id, body = excluded.body, etag = excluded.etag;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION accounts_rebuild_lookups() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP <> 'INSERT' THEN
+    PERFORM rebuild_lookups(OLD.user_id);
+  END IF;
+  IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND NEW.user_id <> OLD.user_id) THEN
+    PERFORM rebuild_lookups(NEW.user_id);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER accounts_rebuild_lookups AFTER INSERT OR UPDATE OR DELETE ON accounts
+  FOR EACH ROW EXECUTE PROCEDURE accounts_rebuild_lookups();
+
+SELECT rebuild_lookups(user_id) FROM (SELECT DISTINCT user_id FROM accounts) AS users;
+
+COMMIT;
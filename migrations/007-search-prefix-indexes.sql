@@ -0,0 +1,7 @@
+-- btree indexes for the anchored prefix pass of /search, which reads
+-- `limit` rows from each in order; the trigram indexes only serve the fuzzy
+-- pass that fills whatever is left
+CREATE INDEX CONCURRENTLY IF NOT EXISTS accounts_user_id_prefix
+  ON accounts (user_id text_pattern_ops, account text_pattern_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS accounts_account_prefix
+  ON accounts (account text_pattern_ops);
@@ -0,0 +1,11 @@
+-- the fuzzy pass of /search orders by trigram distance (`<->`) and stops
+-- after `limit` rows, which needs gist indexes: gin ones can only find every
+-- match, to be sorted afterwards. they replace the gin indexes from 002,
+-- which nothing else uses now that prefixes have their own btrees (007)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS accounts_user_id_trgm_gist
+  ON accounts USING gist (user_id gist_trgm_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS accounts_account_trgm_gist
+  ON accounts USING gist (account gist_trgm_ops);
+
+DROP INDEX CONCURRENTLY IF EXISTS accounts_user_id_trgm;
+DROP INDEX CONCURRENTLY IF EXISTS accounts_account_trgm;
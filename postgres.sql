@@ -1,4 +1,116 @@
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
 CREATE TABLE accounts (
-  account text PRIMARY KEY,
-  user_id text
+  account text PRIMARY KEY CHECK (account = rtrim(lower(trim(account)), '.')),
+  user_id text NOT NULL,
+  seq bigint NOT NULL DEFAULT 0
+);
+
+CREATE INDEX accounts_user_id ON accounts (user_id);
+CREATE UNIQUE INDEX accounts_seq ON accounts (seq);
+CREATE INDEX accounts_user_id_prefix
+  ON accounts (user_id text_pattern_ops, account text_pattern_ops);
+CREATE INDEX accounts_account_prefix ON accounts (account text_pattern_ops);
+CREATE INDEX accounts_user_id_trgm_gist ON accounts USING gist (user_id gist_trgm_ops);
+CREATE INDEX accounts_account_trgm_gist ON accounts USING gist (account gist_trgm_ops);
+
+-- every write to accounts gets the next number from this counter. the row
+-- lock on the counter is held until commit, so numbers become visible in
+-- order and /changes?since=n never skips a write that commits late.
+CREATE TABLE accounts_changes (last bigint NOT NULL);
+INSERT INTO accounts_changes VALUES (0);
+
+CREATE OR REPLACE FUNCTION accounts_next_seq() RETURNS trigger AS $$
+BEGIN
+  UPDATE accounts_changes SET last = last + 1 RETURNING last INTO NEW.seq;
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER accounts_next_seq BEFORE INSERT OR UPDATE ON accounts
+  FOR EACH ROW EXECUTE PROCEDURE accounts_next_seq();
+
+-- ready-to-send /lookup responses, one row per username and per account,
+-- rebuilt by a trigger in the same transaction as every write to accounts
+CREATE TABLE lookups (
+  name text PRIMARY KEY,
+  user_id text NOT NULL,
+  body text NOT NULL,
+  etag text NOT NULL
+);
+
+CREATE INDEX lookups_user_id ON lookups (user_id);
+
+-- same as helpers.account_type
+CREATE OR REPLACE FUNCTION account_type(account text) RETURNS text AS $$
+  SELECT CASE
+    WHEN position('@' in account) = 0 THEN
+      CASE
+        WHEN account ~ '^\+\d+$' THEN 'phone'
+        WHEN position('.' in account) > 0 THEN 'domain'
+      END
+    WHEN split_part(account, '@', 2) LIKE '%.%' THEN 'email'
+    ELSE split_part(account, '@', 2)
+  END
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION rebuild_lookups(uid text) RETURNS void AS $$
+DECLARE
+  doc text;
+BEGIN
+  DELETE FROM lookups WHERE user_id = uid;
+
+  SELECT json_build_object(
+    'accounts', json_agg(
+      json_build_object('account', account, 'type', account_type(account))
+      ORDER BY seq
+    ),
+    'id', uid
+  )::text INTO doc
+  FROM accounts WHERE user_id = uid HAVING count(*) > 0;
+
+  IF doc IS NULL THEN
+    RETURN;
+  END IF;
+
+  INSERT INTO lookups (name, user_id, body, etag)
+  SELECT DISTINCT name, uid, doc, md5(doc)
+  FROM (SELECT uid AS name UNION SELECT account FROM accounts WHERE user_id = uid) AS names
+  ON CONFLICT (name) DO UPDATE
+  SET user_id = excluded.user_id, body = excluded.body, etag = excluded.etag;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION accounts_rebuild_lookups() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP <> 'INSERT' THEN
+    PERFORM rebuild_lookups(OLD.user_id);
+  END IF;
+  IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND NEW.user_id <> OLD.user_id) THEN
+    PERFORM rebuild_lookups(NEW.user_id);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER accounts_rebuild_lookups AFTER INSERT OR UPDATE OR DELETE ON accounts
+  FOR EACH ROW EXECUTE PROCEDURE accounts_rebuild_lookups();
+
+CREATE TABLE events (
+  id text NOT NULL, -- redis stream entry id
+  kind text NOT NULL,
+  user_id text,
+  account text,
+  provider text,
+  created_at timestamptz NOT NULL,
+  data jsonb,
+  PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE TABLE clients (
+  client_id text PRIMARY KEY,
+  site_name text,
+  redirect_prefixes text[] NOT NULL,
+  token_lifetime integer, -- seconds, tokens don't expire when null
+  providers text[] -- all providers are allowed when null
 );
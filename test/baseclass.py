@@ -1,26 +1,51 @@
 import os
 import unittest
+from unittest import mock
 
-from app import app, pg
+from app import app, get_pg, get_redis, clients, snapshot, store
 
 
 if 'amazonaws' in os.getenv('DATABASE_URL'):
     os.exit(1)
 
+def reset_postgres():
+    pg = get_pg()
+    pg.rollback()
+    with pg.cursor() as c:
+        c.execute('drop table if exists accounts, accounts_changes, lookups, events, clients')
+        with open('postgres.sql') as f:
+            c.execute(f.read())
+    pg.commit()
+
 class TestCase(unittest.TestCase):
     def setUp(self):
         app.testing = True
         self.app = app.test_client()
 
-        pg.rollback()
-        with pg.cursor() as c:
-            c.execute('drop table if exists accounts')
-            with open('postgres.sql') as f:
-                c.execute(f.read())
-        pg.commit()
+        # accounts are kept wherever STORE says, in memory by default
+        self.store = store.get_store()
+        if isinstance(self.store, store.MemoryStore):
+            self.store.clear()
+        else:
+            reset_postgres()
+
+        get_redis().flushdb()
+        clients.invalidate()
+        snapshot.clear()
 
     def tearDown(self):
         pass
 
+class PostgresTestCase(TestCase):
+    # for what only happens with accounts in postgres, or must be shared
+    # between processes
+    def setUp(self):
+        patch = mock.patch.dict(store._config, {'STORE': 'postgres'})
+        patch.start()
+        self.addCleanup(patch.stop)
+
+        self.pg = get_pg()
+        super(PostgresTestCase, self).setUp()
+
 if __name__ == '__main__':
     unittest.main()
@@ -2,9 +2,23 @@ import os
 import re
 import jwt
 import json
+import time
+import fcntl
+import shutil
+import socket
+import tempfile
+import threading
+import multiprocessing
+from unittest import mock
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
 
-from baseclass import TestCase
-from app import pg
+import psycopg2
+import requests
+
+from baseclass import TestCase, PostgresTestCase
+from app import app, get_pg, get_redis, events, breaker, clients, snapshot, store
+from app.helpers import normalize_account
 
 
 class TestAuthFlow(TestCase):
@@ -12,16 +26,29 @@ class TestAuthFlow(TestCase):
         r = self.app.get('/')
         self.assertEqual(r.status_code, 200)
 
+    def test_cached_pages_revalidate(self):
+        r = self.app.get('/login-screen?site_name=banana.com')
+        self.assertEqual(r.status_code, 200)
+        self.assertIn('banana.com', r.data.decode('utf-8'))
+        etag = r.headers['ETag']
+
+        r = self.app.get('/login-screen?site_name=banana.com',
+                         headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 304)
+
+        r = self.app.get('/login-screen?site_name=xamuza.com',
+                         headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 200)
+        self.assertIn('xamuza.com', r.data.decode('utf-8'))
+
     def test_get_public_key(self):
         r = self.app.get('/public-key')
         self.assertEqual(r.status_code, 200)
         self.assertEqual(r.data, os.getenv('PUBLIC_KEY').replace('\\n', '\n').encode('ascii'))
 
     def test_lookup(self):
-        with pg.cursor() as c:
-            c.execute('''insert into accounts values ('xamuza.com', 'xamuza')''')
-            c.execute('''insert into accounts values ('x@muza.com', 'xamuza')''')
-        pg.commit()
+        self.store.register('xamuza', 'xamuza.com')
+        self.store.register('xamuza', 'x@muza.com')
 
         # query with the username
         r = self.app.get('/lookup/xamuza')
@@ -43,6 +70,98 @@ class TestAuthFlow(TestCase):
         self.assertEqual(user['accounts'][1]['type'], 'email')
         self.assertEqual(user['accounts'][1]['account'], 'x@muza.com')
 
+    def test_register_existing_account(self):
+        self.store.register('banana', 'b1@test')
+        self.assertRaises(store.AccountExists, self.store.register, 'xamuza', 'b1@test')
+        self.assertEqual(self.store.resolve('b1@test')[0], 'banana')
+
+    def test_search(self):
+        self.store.register('xamuza', 'xamuza.com')
+        self.store.register('banana', 'b1@test')
+        self.store.register('bananada', 'b2@test')
+
+        r = self.app.get('/search?q=bana')
+        results = json.loads(r.data.decode('utf-8'))['results']
+        self.assertEqual([x['id'] for x in results], ['banana', 'bananada'])
+        self.assertEqual(results[0]['account'], 'b1@test')
+        self.assertEqual(results[0]['type'], 'test')
+
+        r = self.app.get('/search?q=xamusa')
+        results = json.loads(r.data.decode('utf-8'))['results']
+        self.assertEqual(results[0]['id'], 'xamuza')
+
+        r = self.app.get('/search?q=b')
+        self.assertEqual(r.status_code, 400)
+
+    def test_search_ranks_prefix_hits_first(self):
+        self.store.register('zeca', 'bananas.com')
+        self.store.register('banana', 'b1@test')
+        self.store.register('bananada', 'b2@test')
+        self.store.register('bnanaa', 'b3@test')
+
+        self.assertEqual(self.store.search('banana', 10), [
+            ('banana', 'b1@test'),
+            ('bananada', 'b2@test'),
+            ('zeca', 'bananas.com'),
+            ('bnanaa', 'b3@test'),
+        ])
+        self.assertEqual(self.store.search('banana', 2),
+                         [('banana', 'b1@test'), ('bananada', 'b2@test')])
+
+    def test_changes(self):
+        r = self.app.get('/changes')
+        feed = json.loads(r.data.decode('utf-8'))
+        self.assertEqual(feed['changes'], [])
+        since = feed['next']
+
+        self.app.get('/login/as/banana/with/b1@test', follow_redirects=True)
+        self.app.get('/login/as/banana/with/b2@test', follow_redirects=True)
+
+        r = self.app.get('/changes?since={}&limit=1'.format(since))
+        feed = json.loads(r.data.decode('utf-8'))
+        self.assertEqual([c['account'] for c in feed['changes']], ['b1@test'])
+        self.assertTrue(feed['more'])
+
+        r = self.app.get('/changes?since={}'.format(feed['next']))
+        feed = json.loads(r.data.decode('utf-8'))
+        self.assertEqual([c['account'] for c in feed['changes']], ['b2@test'])
+        self.assertEqual(feed['changes'][0]['id'], 'banana')
+        self.assertFalse(feed['more'])
+
+        # a relinked account shows up again
+        self.store.move('xamuza', 'b1@test')
+        r = self.app.get('/changes?since={}'.format(feed['next']))
+        feed = json.loads(r.data.decode('utf-8'))
+        self.assertEqual([(c['account'], c['id']) for c in feed['changes']],
+                         [('b1@test', 'xamuza')])
+
+    def test_changes_event_stream(self):
+        self.app.get('/login/as/banana/with/b1@test', follow_redirects=True)
+        stream = {'Accept': 'text/event-stream'}
+
+        # without room for streams clients get the paginated feed
+        r = self.app.get('/changes?since=0', headers=stream)
+        self.assertEqual(r.mimetype, 'application/json')
+
+        with mock.patch.dict(app.config, {'CHANGES_MAX_STREAMS': 1}):
+            r = self.app.get('/changes?since=0', buffered=False, headers=stream)
+            self.assertEqual(r.mimetype, 'text/event-stream')
+            event = next(r.response)
+            if isinstance(event, bytes):
+                event = event.decode('utf-8')
+            self.assertTrue(event.startswith('id: '))
+            data = json.loads(event.split('data: ')[1])
+            self.assertEqual(data['account'], 'b1@test')
+
+            # the only slot is taken
+            busy = self.app.get('/changes?since=0', headers=stream)
+            self.assertEqual(busy.status_code, 503)
+            r.close()
+
+            r = self.app.get('/changes?since=0', buffered=False, headers=stream)
+            self.assertEqual(r.status_code, 200)
+            r.close()
+
     def fail_auth_wrong_account(self):
         r = self.app.get('/login/as/banana/with/banana@test')
         self.assertEqual(r.status_code, 302)
@@ -139,11 +258,75 @@ class TestAuthFlow(TestCase):
         self.assertEqual(user['accounts'][1]['type'], 'test')
         self.assertEqual(user['accounts'][1]['account'], 'b2@test')
 
+    def test_account_case_is_normalized(self):
+        r = self.app.get('/login/as/banana/with/B1@Test', follow_redirects=True)
+        self.assertEqual(r.status_code, 200)
+
+        # logging in again with a different casing hits the same account
+        r = self.app.get('/login/with/b1@TEST', follow_redirects=True)
+        self.assertEqual(r.status_code, 200)
+        r = self.app.post('/verify/' + r.data.decode('utf-8'))
+        self.assertEqual(json.loads(r.data.decode('utf-8'))['user'], 'banana')
+
+        r = self.app.get('/lookup/B1@test')
+        user = json.loads(r.data.decode('utf-8'))
+        self.assertEqual(user['id'], 'banana')
+        self.assertEqual(len(user['accounts']), 1)
+        self.assertEqual(user['accounts'][0]['account'], 'b1@test')
+
+    def test_session_id_changes_on_login(self):
+        def session_cookie(r):
+            return re.search('session=([^;]+)', r.headers['Set-Cookie']).group(1)
+
+        # a cookie someone could have planted before the login
+        r = self.app.get('/login/as/banana/with/b1@test')
+        planted = session_cookie(r)
+
+        r = self.app.get(r.headers['Location'])
+        self.assertEqual(r.status_code, 200)
+        self.assertNotEqual(session_cookie(r), planted)
+
+        other = app.test_client()
+        other.set_cookie('localhost', 'session', planted)
+        with other.session_transaction() as session:
+            self.assertNotIn('authorized_accounts', session)
+            self.assertNotIn('remembered', session)
+        with self.app.session_transaction() as session:
+            self.assertIn('b1@test', session['authorized_accounts'])
+
+    def test_remembered_identity(self):
+        def login_user():
+            r = self.app.get('/login/with/b1@test', follow_redirects=True)
+            self.assertEqual(r.status_code, 200)
+            r = self.app.post('/verify/' + r.data.decode('utf-8'))
+            return json.loads(r.data.decode('utf-8'))['user']
+
+        r = self.app.get('/login/as/banana/with/b1@test', follow_redirects=True)
+        self.assertEqual(r.status_code, 200)
+
+        resolve = mock.patch.object(self.store, 'resolve', wraps=self.store.resolve)
+        related = mock.patch.object(self.store, 'related', wraps=self.store.related)
+
+        # returning soon after doesn't touch the store
+        with resolve as resolved, related as listed:
+            self.assertEqual(login_user(), 'banana')
+            self.assertEqual(resolved.call_count, 0)
+            self.assertEqual(listed.call_count, 0)
+
+        # later it checks the binding once
+        with mock.patch('app.main.REMEMBER_FRESH_FOR', -1):
+            with resolve as resolved, related as listed:
+                self.assertEqual(login_user(), 'banana')
+                self.assertEqual(resolved.call_count, 1)
+                self.assertEqual(listed.call_count, 0)
+
+            # and notices when the account has moved
+            self.store.move('xamuza', 'b1@test')
+            self.assertEqual(login_user(), 'xamuza')
+
     def test_two_without_initial_auth(self):
         # first account is created on the database
-        with pg:
-            with pg.cursor() as c:
-                c.execute('''INSERT INTO accounts VALUES ('b1@test', 'banana')''')
+        self.store.register('banana', 'b1@test')
 
         # then we try to login with a second one
         # we're automatically redirected to login with the first one
@@ -162,11 +345,9 @@ class TestAuthFlow(TestCase):
 
     def test_multiple_without_initial_auth(self):
         # many accounts are created
-        with pg:
-            with pg.cursor() as c:
-                c.execute('''INSERT INTO accounts VALUES ('b1@test', 'banana')''')
-                c.execute('''INSERT INTO accounts VALUES ('b2@test', 'banana')''')
-                c.execute('''INSERT INTO accounts VALUES ('b3@test', 'banana')''')
+        self.store.register('banana', 'b1@test')
+        self.store.register('banana', 'b2@test')
+        self.store.register('banana', 'b3@test')
 
         # then we try to login with a new one
         r = self.app.get('/login/as/banana/with/b4@test')
@@ -188,3 +369,685 @@ class TestAuthFlow(TestCase):
         # check token
         r = self.app.post('/verify/' + token.decode('utf-8'))
         self.assertEqual(json.loads(r.data.decode('utf-8'))['user'], 'banana')
+
+
+class TestPostgres(PostgresTestCase):
+    def test_lookup_revalidates(self):
+        pg = self.pg
+        with pg:
+            with pg.cursor() as c:
+                c.execute('''insert into accounts values ('xamuza.com', 'xamuza')''')
+
+        r = self.app.get('/lookup/xamuza.com')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers['Content-Type'], 'application/json')
+        etag = r.headers['ETag']
+
+        r = self.app.get('/lookup/xamuza', headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 304)
+
+        # moving the account to another user changes both documents
+        with pg:
+            with pg.cursor() as c:
+                c.execute('''insert into accounts values ('x@muza.com', 'xamuza')''')
+                c.execute('''update accounts set user_id = 'muza' where account = 'xamuza.com' ''')
+
+        r = self.app.get('/lookup/xamuza.com', headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 200)
+        user = json.loads(r.data.decode('utf-8'))
+        self.assertEqual(user['id'], 'muza')
+        self.assertEqual([a['account'] for a in user['accounts']], ['xamuza.com'])
+
+        r = self.app.get('/lookup/xamuza')
+        user = json.loads(r.data.decode('utf-8'))
+        self.assertEqual([a['account'] for a in user['accounts']], ['x@muza.com'])
+
+        # and the last account leaving a user removes it
+        with pg:
+            with pg.cursor() as c:
+                c.execute('''delete from accounts where account = 'x@muza.com' ''')
+        r = self.app.get('/lookup/xamuza')
+        self.assertEqual(json.loads(r.data.decode('utf-8')), {'id': None, 'type': None})
+
+    def test_search_prefix_uses_the_btrees(self):
+        for i in range(50):
+            self.store.register('user{:02}'.format(i), 'u{:02}@test'.format(i))
+        self.store.register('zeca', 'user_zeca.com')
+
+        # a full page of prefix hits never runs the trigram pass
+        self.assertEqual(self.store.search('user_', 1), [('zeca', 'user_zeca.com')])
+        self.assertEqual(self.store.search('user', 3), [
+            ('user00', 'u00@test'), ('user01', 'u01@test'), ('user02', 'u02@test'),
+        ])
+
+        with self.pg:
+            with self.pg.cursor() as c:
+                c.execute('set local enable_seqscan = off')
+                c.execute('''
+                    explain select user_id, account from accounts
+                    where account like 'u4%' order by account using ~<~ limit 3
+                ''')
+                self.assertIn('accounts_account_prefix', str(c.fetchall()))
+
+    def test_snapshot_never_goes_back(self):
+        self.store.register('banana', 'b1@test')
+        self.assertEqual(snapshot.refresh(), 1)
+
+        # a newer copy of the row made by someone else, while this refresher
+        # starts over from an older seq
+        db = snapshot._db()
+        with db:
+            db.execute("update accounts set user_id = 'xamuza', seq = 1000")
+            db.execute("insert or replace into meta values ('seq', 0)")
+        snapshot.refresh()
+        self.assertEqual(snapshot.resolve('b1@test'), 'xamuza')
+
+        # nor does the seq go back
+        with db:
+            db.execute("insert or replace into meta values ('seq', 1000)")
+        self.store.register('banana', 'b2@test')
+        with mock.patch.object(snapshot, '_meta', return_value=0):
+            snapshot.refresh()
+        self.assertEqual(snapshot._meta(db, 'seq'), 1000)
+
+    def test_one_snapshot_refresher_per_file(self):
+        other = open(app.config['SNAPSHOT_PATH'] + '.lock', 'w')
+        self.addCleanup(other.close)
+        fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        with mock.patch.dict(snapshot._lock, clear=True):
+            self.assertFalse(snapshot._holds_lock())
+            fcntl.flock(other, fcntl.LOCK_UN)
+            self.assertTrue(snapshot._holds_lock())
+            snapshot._lock['file'].close()
+
+    def test_unreachable_database_isnt_retried_at_once(self):
+        from app import connections
+
+        attempts = []
+
+        def connect(*args, **kwargs):
+            attempts.append(1)
+            raise psycopg2.OperationalError('unreachable')
+
+        clients.save('banana', ['https://banana.com/'])
+        snapshot.refresh()
+        clients._policies = None
+
+        with mock.patch.object(connections, '_pg', None), \
+                mock.patch.object(connections, '_pg_down_until', 0), \
+                mock.patch.object(connections.psycopg2, 'connect', side_effect=connect):
+            for _ in range(3):
+                self.assertRaises(psycopg2.OperationalError, get_pg)
+                self.assertEqual(clients.find('https://banana.com/').client_id, 'banana')
+                self.app.get('/lookup/banana')
+            self.assertEqual(len(attempts), 1)
+
+            # until it may be back
+            connections._pg_down_until = 0
+            clients._loaded_at -= connections.RETRY_AFTER
+            clients.find('https://banana.com/')
+            self.assertEqual(len(attempts), 2)
+
+    def test_normalized_accounts_pass_the_check(self):
+        for account in ['a.com .', ' B.com. . ', 'x@Muza.com\t.', 'c.com. \n', 'b1@test']:
+            normalized = normalize_account(account)
+            self.assertEqual(normalize_account(normalized), normalized)
+            with self.pg:
+                with self.pg.cursor() as c:
+                    c.execute('insert into accounts values (%s, %s)', (normalized, 'banana'))
+
+    def test_accounts_are_stored_canonical(self):
+        for account in ['Xamuza.com', ' xamuza.com', 'xamuza.com.']:
+            with self.assertRaises(psycopg2.IntegrityError):
+                with self.pg:
+                    with self.pg.cursor() as c:
+                        c.execute('insert into accounts values (%s, %s)', (account, 'xamuza'))
+
+    def test_database_down(self):
+        clients.save('banana', ['https://banana.com/'], token_lifetime=60)
+        r = self.app.get('/login/as/banana/with/b1@test', follow_redirects=True)
+        r = self.app.get('/login/as/banana/with/b2@test', follow_redirects=True)
+        self.assertEqual(snapshot.refresh(), 2)
+        self.assertEqual(snapshot.refresh(), 0)
+
+        pg = self.pg
+        with pg:
+            with pg.cursor() as c:
+                c.execute('''insert into accounts values ('xamuza.com', 'xamuza')''')
+        self.assertEqual(snapshot.refresh(), 1)
+
+        down = mock.patch('app.store.get_pg', side_effect=psycopg2.OperationalError)
+        with down:
+            r = self.app.get('/lookup/banana')
+            self.assertEqual(r.status_code, 200)
+            user = json.loads(r.data.decode('utf-8'))
+            self.assertEqual(user['id'], 'banana')
+            self.assertEqual([a['account'] for a in user['accounts']], ['b1@test', 'b2@test'])
+            self.assertEqual(user['accounts'][0]['type'], 'test')
+            self.assertTrue(user['stale'])
+            self.assertEqual(user['as_of'], snapshot.as_of())
+
+            r = self.app.get('/lookup/nobody.com')
+            self.assertEqual(json.loads(r.data.decode('utf-8'))['type'], 'domain')
+
+            # returning users can still login
+            self.app = app.test_client()
+            r = self.app.get('/login/with/b2@test', follow_redirects=True)
+            self.assertEqual(r.status_code, 200)
+            r = self.app.post('/verify/' + r.data.decode('utf-8'))
+            self.assertEqual(json.loads(r.data.decode('utf-8'))['user'], 'banana')
+
+            # even in a process that hasn't loaded the client policies
+            clients._policies = None
+            r = self.app.get('/login/with/b2@test?redirect_uri=https://banana.com/')
+            r = self.app.get(r.headers['Location'])
+            self.assertEqual(r.status_code, 302)
+            token = r.headers['Location'].split('?token=')[1]
+            r = self.app.post('/verify/' + token)
+            self.assertIn('exp', json.loads(r.data.decode('utf-8')))
+
+            # but nothing can be registered or linked
+            r = self.app.get('/login/as/banana/with/b3@test', follow_redirects=True)
+            self.assertEqual(r.status_code, 503)
+            r = self.app.get('/login/with/new@test', follow_redirects=True)
+            self.assertEqual(r.status_code, 503)
+
+        # a snapshot that was never refreshed can't answer
+        snapshot.clear()
+        clients._policies = None
+        with down:
+            r = self.app.get('/lookup/banana')
+            self.assertEqual(r.status_code, 503)
+            r = self.app.get('/login/with/b2@test?redirect_uri=https://banana.com/')
+            self.assertEqual(r.status_code, 503)
+
+
+class TestWorkers(PostgresTestCase):
+    def test_forked_workers_get_their_own_connection(self):
+        pg = self.pg
+
+        # the parent has a connection open before forking, as gunicorn's
+        # master would with --preload
+        with pg.cursor() as c:
+            c.execute('select pg_backend_pid()')
+            (parent_backend,) = c.fetchone()
+        pg.commit()
+
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                conn = get_pg()
+                with conn.cursor() as c:
+                    c.execute('select pg_backend_pid()')
+                    os.write(write, str(c.fetchone()[0]).encode('ascii'))
+                conn.close()
+            finally:
+                os._exit(0)
+
+        os.waitpid(pid, 0)
+        child_backend = int(os.read(read, 32).decode('ascii'))
+        self.assertNotEqual(child_backend, parent_backend)
+
+        # and the child didn't break the parent's connection
+        self.assertIs(get_pg(), pg)
+        with pg.cursor() as c:
+            c.execute('select pg_backend_pid()')
+            self.assertEqual(c.fetchone()[0], parent_backend)
+        pg.commit()
+
+
+class TestEvents(PostgresTestCase):
+    def test_login_events_reach_postgres(self):
+        # leave out whatever previous tests have emitted
+        events.flush()
+        get_redis().delete(events.STREAM)
+
+        r = self.app.get('/login/as/banana/with/b1@test', follow_redirects=True)
+        self.assertEqual(r.status_code, 200)
+        r = self.app.get('/login/as/banana/with/b2@test', follow_redirects=True)
+        self.assertEqual(r.status_code, 200)
+
+        events.flush()
+        self.assertEqual(get_redis().execute_command('XLEN', events.STREAM), 4)
+
+        events.consume('tester', block=10, once=True)
+        pg = self.pg
+        with pg:
+            with pg.cursor() as c:
+                c.execute('''
+                    select kind, user_id, account, provider from events
+                    order by id
+                ''')
+                self.assertEqual(c.fetchall(), [
+                    ('registration', 'banana', 'b1@test', 'test'),
+                    ('token', 'banana', None, None),
+                    ('link', 'banana', 'b2@test', 'test'),
+                    ('token', 'banana', None, None),
+                ])
+
+        # everything was acknowledged
+        pending = get_redis().execute_command(
+            'XREADGROUP', 'GROUP', events.GROUP, 'tester',
+            'STREAMS', events.STREAM, '0')
+        self.assertEqual(len(pending[0][1]), 0)
+
+    def test_abandoned_events_are_taken_over(self):
+        events.flush()
+        get_redis().delete(events.STREAM)
+        get_redis().execute_command(
+            'XGROUP', 'CREATE', events.STREAM, events.GROUP, '0', 'MKSTREAM')
+
+        self.app.get('/login/as/banana/with/b1@test', follow_redirects=True)
+        events.flush()
+
+        # a consumer reads them and dies before acknowledging
+        get_redis().execute_command(
+            'XREADGROUP', 'GROUP', events.GROUP, 'dead',
+            'STREAMS', events.STREAM, '>')
+
+        # they aren't taken while they could still be acknowledged
+        events.consume('tester', block=10, once=True)
+        with self.pg:
+            with self.pg.cursor() as c:
+                c.execute('select count(*) from events')
+                self.assertEqual(c.fetchone()[0], 0)
+
+        with mock.patch.object(events, 'CLAIM_IDLE', 0):
+            events.consume('tester', block=10, once=True)
+        with self.pg:
+            with self.pg.cursor() as c:
+                c.execute('select kind from events order by id')
+                self.assertEqual(c.fetchall(), [('registration',), ('token',)])
+
+        for consumer in ['dead', 'tester']:
+            pending = get_redis().execute_command(
+                'XREADGROUP', 'GROUP', events.GROUP, consumer,
+                'STREAMS', events.STREAM, '0')
+            self.assertEqual(len(pending[0][1]), 0)
+
+    @mock.patch.object(events, 'BUFFER_SIZE', 2)
+    def test_full_buffer_drops_are_counted(self):
+        events.flush()
+        before = events.stats()['dropped']
+
+        # keep the flusher out while the buffer is full
+        with events._flush_lock:
+            with self.assertLogs('app.events', 'WARNING'):
+                for _ in range(3):
+                    events.emit('login', user='banana')
+            self.assertEqual(events.stats()['dropped'], before + 1)
+            self.assertEqual(events.stats()['buffered'], 2)
+
+        events.flush()
+        self.assertEqual(int(get_redis().get(events.DROPPED)), 1)
+
+    @mock.patch.object(events, 'EXIT_RETRIES', 1)
+    def test_exit_without_redis_spills_to_disk(self):
+        events.flush()
+        get_redis().delete(events.STREAM)
+        spill_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spill_dir)
+
+        with mock.patch.dict(events._config, {'SPILL_DIR': spill_dir}):
+            with mock.patch.object(events, '_publish', side_effect=ConnectionError):
+                events.emit('login', user='banana')
+                events.emit('login', user='xamuza')
+                with self.assertLogs('app.events', 'WARNING'):
+                    events.flush_on_exit()
+            self.assertEqual(events.stats()['buffered'], 0)
+            self.assertEqual(len(os.listdir(spill_dir)), 1)
+
+            events.replay()
+            self.assertEqual(os.listdir(spill_dir), [])
+
+        self.assertEqual(get_redis().execute_command('XLEN', events.STREAM), 2)
+
+
+class StubProvider(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    # what the next requests will get, as (delay, status); when empty
+    # requests get `default`
+    script = []
+    default = (0, 200)
+    hits = 0
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.hits += 1
+        delay, status = server.script.pop(0) if server.script else server.default
+        time.sleep(delay)
+        self.send_response(status)
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, *args):
+        pass
+
+
+class TestBreaker(TestCase):
+    def setUp(self):
+        super(TestBreaker, self).setUp()
+        self.stub = StubProvider(('127.0.0.1', 0), StubHandler)
+        self.stub.script = []
+        self.url = 'http://127.0.0.1:{}/'.format(self.stub.server_port)
+        threading.Thread(target=self.stub.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.stub.shutdown()
+        self.stub.server_close()
+
+    def call(self):
+        with breaker.guard('stub'):
+            r = requests.get(self.url, timeout=breaker.TIMEOUT)
+            if r.status_code >= 500:
+                raise Exception('stub is failing')
+
+    @mock.patch.object(breaker, 'OPEN_DURATION', 1)
+    def test_circuit_opens_and_recovers(self):
+        self.stub.default = (0, 500)
+        for _ in range(breaker.FAILURE_THRESHOLD):
+            self.assertRaisesRegex(Exception, 'failing', self.call)
+
+        # now it fails fast, without reaching the provider
+        self.assertRaises(breaker.ProviderUnavailable, self.call)
+        self.assertEqual(self.stub.hits, breaker.FAILURE_THRESHOLD)
+
+        # half-open: a failing probe opens it again
+        time.sleep(1.1)
+        self.assertRaisesRegex(Exception, 'failing', self.call)
+        self.assertRaises(breaker.ProviderUnavailable, self.call)
+
+        # and a successful one closes it
+        time.sleep(1.1)
+        self.stub.default = (0, 200)
+        self.call()
+        self.call()
+        self.assertEqual(self.stub.hits, breaker.FAILURE_THRESHOLD + 3)
+
+    @mock.patch.object(breaker, 'TIMEOUT', 0.2)
+    def test_slow_provider_counts_as_failure(self):
+        self.stub.default = (1, 200)
+        for _ in range(breaker.FAILURE_THRESHOLD):
+            self.assertRaises(requests.exceptions.Timeout, self.call)
+
+        start = time.time()
+        self.assertRaises(breaker.ProviderUnavailable, self.call)
+        self.assertLess(time.time() - start, 0.1)
+
+    @mock.patch.object(breaker, 'MAX_CONCURRENT', 2)
+    def test_concurrency_cap(self):
+        self.stub.default = (0.5, 200)
+        results = []
+
+        def worker():
+            try:
+                self.call()
+                results.append('ok')
+            except breaker.ProviderUnavailable:
+                results.append('rejected')
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(sorted(results), ['ok', 'ok', 'rejected', 'rejected'])
+
+        # slots are given back
+        self.call()
+
+    @mock.patch.object(breaker, 'MAX_CONCURRENT', 1)
+    def test_abandoned_slots_expire(self):
+        # a call whose worker was killed never gives its slot back
+        get_redis().execute_command('ZADD', 'breaker:stub:inflight', time.time() - 1, 'dead')
+        self.call()
+
+        get_redis().execute_command('ZADD', 'breaker:stub:inflight', time.time() + 60, 'dead')
+        self.assertRaises(breaker.ProviderUnavailable, self.call)
+
+    def test_hedged_get(self):
+        self.stub.script = [(2, 200)]
+
+        start = time.time()
+        with breaker.guard('stub'):
+            r = breaker.hedged(lambda: requests.get(self.url, timeout=5), 'stub', delay=0.2)
+        self.assertEqual(r.status_code, 200)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(self.stub.hits, 2)
+
+        # the slow first request still holds the hedge's slot
+        self.assertEqual(get_redis().zcard('breaker:stub:inflight'), 1)
+        time.sleep(2)
+        self.assertEqual(get_redis().zcard('breaker:stub:inflight'), 0)
+
+    @mock.patch.object(breaker, 'MAX_CONCURRENT', 1)
+    def test_no_hedge_without_a_free_slot(self):
+        self.stub.script = [(0.5, 200)]
+
+        with breaker.guard('stub'):
+            r = breaker.hedged(lambda: requests.get(self.url, timeout=5), 'stub', delay=0.1)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.stub.hits, 1)
+
+    def test_unavailable_provider_returns_503(self):
+        from app import test as test_provider
+
+        get_redis().set('breaker:test:open', 1)
+        original = test_provider.callback
+
+        def guarded():
+            with breaker.guard('test'):
+                return original()
+
+        with mock.patch.object(test_provider, 'callback', guarded):
+            r = self.app.get('/login/as/banana/with/b1@test')
+            r = self.app.get(r.headers['Location'])
+        self.assertEqual(r.status_code, 503)
+
+
+class TestClients(TestCase):
+    def setUp(self):
+        super(TestClients, self).setUp()
+        r = app.test_cli_runner().invoke(args=[
+            'clients', 'add', 'banana',
+            '--redirect', 'https://banana.com/',
+            '--site-name', 'Banana',
+            '--token-lifetime', '60',
+            '--provider', 'test',
+            '--provider', 'github',
+        ])
+        self.assertEqual(r.exit_code, 0, r.output)
+
+    def test_list(self):
+        r = app.test_cli_runner().invoke(args=['clients', 'list'])
+        self.assertIn('banana\tBanana\thttps://banana.com/\t60\tgithub,test', r.output)
+
+        r = app.test_cli_runner().invoke(args=['clients', 'remove', 'banana'])
+        self.assertEqual(r.exit_code, 0, r.output)
+        r = app.test_cli_runner().invoke(args=['clients', 'list'])
+        self.assertEqual(r.output, '')
+
+    def test_login_screen_uses_client_policy(self):
+        r = self.app.get('/login-screen?redirect_uri=https://banana.com/x')
+        html = r.data.decode('utf-8')
+        self.assertIn('Trying to login to Banana', html)
+        self.assertIn('/login/using/github', html)
+        self.assertNotIn('/login/using/twitter', html)
+        self.assertNotIn('type="email"', html)
+
+    def test_token_lifetime(self):
+        r = self.app.get('/login/as/banana/with/b1@test?redirect_uri=https://banana.com/')
+        r = self.app.get(r.headers['Location'])
+        self.assertEqual(r.status_code, 302)
+        token = r.headers['Location'].split('?token=')[1]
+
+        payload = jwt.decode(
+            token,
+            os.getenv('PUBLIC_KEY').replace('\\n', '\n').encode('ascii'),
+            algorithms='RS256'
+        )
+        self.assertAlmostEqual(payload['exp'], time.time() + 60, delta=5)
+
+    def test_disallowed_provider(self):
+        r = self.app.get('/login/using/twitter?redirect_uri=https://banana.com/')
+        self.assertEqual(r.status_code, 403)
+
+    def test_prefix_matches_only_the_same_host(self):
+        self.assertEqual(clients.find('https://banana.com/x').client_id, 'banana')
+        self.assertEqual(clients.find('HTTPS://Banana.com/').client_id, 'banana')
+        self.assertIsNone(clients.find('https://banana.com.evil.net/'))
+        self.assertIsNone(clients.find('https://banana.com@evil.net/'))
+        self.assertIsNone(clients.find('http://banana.com/'))
+
+    def test_invalid_prefix(self):
+        for prefix in ['https://banana.com', 'banana.com/', 'https://banana.com/x?y=1']:
+            r = app.test_cli_runner().invoke(args=[
+                'clients', 'add', 'banana', '--redirect', prefix])
+            self.assertNotEqual(r.exit_code, 0, prefix)
+            self.assertIn('must look like', r.output)
+
+    def test_disallowed_provider_cannot_finish_elsewhere(self):
+        clients.save('apple', ['https://apple.com/'], providers=['github'])
+
+        # a login started with a provider apple doesn't accept...
+        r = self.app.get('/login/as/banana/with/b1@test')
+        callback = r.headers['Location']
+
+        # ...can't be pointed to apple halfway
+        r = self.app.get('/login/using/test?redirect_uri=https://apple.com/')
+        self.assertEqual(r.status_code, 403)
+        r = self.app.get(callback)
+        self.assertEqual(r.status_code, 200)
+        self.assertNotIn('apple.com', r.headers.get('Location', ''))
+
+        # and the callback checks it again, however it got there
+        r = self.app.get('/login/as/banana/with/b1@test')
+        with self.app.session_transaction() as session:
+            session['redirect_uri'] = 'https://apple.com/'
+        r = self.app.get(r.headers['Location'])
+        self.assertEqual(r.status_code, 403)
+
+    def test_unregistered_redirect_uri(self):
+        r = self.app.get('/login/as/banana/with/b1@test?redirect_uri=https://x.com/')
+        self.assertEqual(r.status_code, 302)
+
+        with mock.patch.dict(app.config, {'REQUIRE_REGISTERED_CLIENTS': True}):
+            r = self.app.get('/login/as/banana/with/b1@test?redirect_uri=https://x.com/')
+            self.assertEqual(r.status_code, 400)
+            r = self.app.get('/login/as/banana/with/b1@test?redirect_uri=https://banana.com/')
+            self.assertEqual(r.status_code, 302)
+
+
+class TestClientsAcrossProcesses(PostgresTestCase):
+    def setUp(self):
+        super(TestClientsAcrossProcesses, self).setUp()
+        clients.save('banana', ['https://banana.com/'], site_name='Banana')
+
+    def test_changes_reach_other_processes(self):
+        self.assertEqual(clients.find('https://banana.com/').site_name, 'Banana')
+
+        # another process updates it
+        pid = os.fork()
+        if pid == 0:
+            try:
+                clients.save('banana', ['https://banana.com/'], site_name='Bananas')
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+        for _ in range(50):
+            if clients._policies is None:
+                break
+            time.sleep(0.01)
+        self.assertEqual(clients.find('https://banana.com/').site_name, 'Bananas')
+
+
+class TestSessions(TestCase):
+    def test_rotated_secret_key(self):
+        self.app.get('/login/as/banana/with/b1@test')
+        old_key = app.secret_key
+
+        with mock.patch.dict(app.config, {'SECRET_KEY': 'new',
+                                          'OLD_SECRET_KEYS': [old_key]}):
+            # still logged in with the session signed by the old key
+            r = self.app.get('/callback/from/test')
+            self.assertEqual(r.status_code, 200)
+            self.assertIn('session=', r.headers['Set-Cookie'])
+
+        # and without it the session is gone
+        with mock.patch.dict(app.config, {'SECRET_KEY': 'newer'}):
+            self.app.get('/login/as/banana/with/b1@test')
+        with mock.patch.dict(app.config, {'SECRET_KEY': 'newest'}):
+            r = self.app.get('/callback/from/test')
+            self.assertEqual(r.status_code, 200)
+            self.assertIn('choose', r.data.decode('utf-8').lower())
+
+    def test_nonces_are_single_use(self):
+        from app import nonces
+
+        nonce = nonces.issue('github')
+        self.assertEqual(nonces.consume('github', nonce), b'1')
+        self.assertIsNone(nonces.consume('github', nonce))
+        self.assertIsNone(nonces.consume('github', 'made-up'))
+
+
+def serve(port):
+    app.testing = True
+    app.run(host='127.0.0.1', port=port, use_reloader=False)
+
+
+class TestScaleOut(PostgresTestCase):
+    def setUp(self):
+        super(TestScaleOut, self).setUp()
+        self.workers = []
+        for _ in range(2):
+            s = socket.socket()
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+            s.close()
+
+            p = multiprocessing.get_context('fork').Process(target=serve, args=(port,))
+            p.start()
+            self.workers.append((p, 'http://127.0.0.1:{}'.format(port)))
+
+        for _, url in self.workers:
+            for _ in range(100):
+                try:
+                    requests.get(url + '/public-key')
+                    break
+                except requests.exceptions.ConnectionError:
+                    time.sleep(0.05)
+
+    def tearDown(self):
+        for p, _ in self.workers:
+            p.terminate()
+            p.join()
+
+    def test_login_across_workers(self):
+        (_, a), (_, b) = self.workers
+        browser = requests.Session()
+
+        # handle runs on one worker...
+        r = browser.get(a + '/login/as/banana/with/b1@test?redirect_uri=https://x.com/',
+                        allow_redirects=False)
+        self.assertEqual(r.status_code, 302)
+        path = r.headers['Location'].split('localhost', 1)[1]
+        self.assertIn('callback/from/test', path)
+
+        # ...and the callback on the other
+        r = browser.get(b + path, allow_redirects=False)
+        self.assertEqual(r.status_code, 302)
+        token = r.headers['Location'].split('?token=')[1]
+        r = browser.post(a + '/verify/' + token)
+        self.assertEqual(r.json()['user'], 'banana')
+
+        # the cookie only carries the session id
+        cookie = browser.cookies.get('session')
+        self.assertNotIn('b1@test', cookie)
+        self.assertEqual(len(cookie.split('.')), 2)